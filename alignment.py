@@ -0,0 +1,119 @@
+"""Module used to find the shift that aligns the fluor and optional images
+with the mask computed on the base image.
+The shift is taken from the maximum of the correlation between the inverted
+mask (cells in white) and the channel image. Two methods are available:
+the full cross-correlation computed with fftconvolve and the phase
+correlation computed with rfft2, which reuses the spectrum of the mask for
+every channel, can limit the search to a window of shifts and can refine
+the shift to a fraction of a pixel.
+The shift is then applied to the images (and to the labels when saved) with
+shift_image."""
+
+import numpy as np
+from scipy import ndimage
+from scipy.signal import fftconvolve
+
+
+def correlation_shift(inverted_mask, image, max_shift=0):
+    """Returns the (row, column) shift of the image that best matches the
+    inverted mask, from the maximum of their full cross-correlation.
+    With max_shift > 0 only shifts up to max_shift pixels in each direction
+    are considered"""
+
+    corr = fftconvolve(inverted_mask, image[::-1, ::-1])
+
+    # position of the null shift in the correlation array
+    center = np.array([(corr.shape[0] - 1) / 2.0, (corr.shape[1] - 1) / 2.0])
+
+    if max_shift > 0:
+        x0, y0 = np.maximum(np.ceil(center - max_shift), 0).astype(int)
+        x1, y1 = np.floor(center + max_shift).astype(int) + 1
+        window = corr[x0:x1, y0:y1]
+        deviation = np.unravel_index(np.argmax(window), window.shape)
+        deviation = np.add(deviation, (x0, y0))
+    else:
+        deviation = np.unravel_index(np.argmax(corr), corr.shape)
+
+    return np.subtract(deviation, center)
+
+
+def mask_spectrum(inverted_mask):
+    """Returns the spectrum of the inverted mask used by
+    phase_correlation_shift. Only needs to be computed once per mask"""
+
+    return np.fft.rfft2(inverted_mask)
+
+
+def phase_correlation_shift(spectrum, image, max_shift=0, subpixel=False):
+    """Returns the (row, column) shift of the image that best matches the
+    mask of the spectrum, from the maximum of their phase correlation, with
+    the magnitude of the weakest frequencies regularised.
+    The image must have the same shape as the mask. The correlation is
+    circular, so shifts are assumed to be smaller than half the image.
+    With max_shift > 0 only shifts up to max_shift pixels in each direction
+    are considered. With subpixel the shift is refined by fitting a parabola
+    to the peak and its neighbours along each axis"""
+
+    h, w = image.shape
+
+    cross = spectrum * np.conj(np.fft.rfft2(image))
+    # the weakest frequencies are mostly noise and whitening them moves the
+    # peak, so magnitudes are only normalised down to 1e-3 of the largest
+    magnitude = np.abs(cross)
+    cross /= np.maximum(magnitude, max(1e-3 * np.amax(magnitude), 1e-12))
+    corr = np.fft.irfft2(cross, s=(h, w))
+
+    if max_shift > 0:
+        rows = np.unique(np.arange(-max_shift, max_shift + 1) % h)
+        cols = np.unique(np.arange(-max_shift, max_shift + 1) % w)
+        window = corr[np.ix_(rows, cols)]
+        r, c = np.unravel_index(np.argmax(window), window.shape)
+        peak = (rows[r], cols[c])
+    else:
+        peak = np.unravel_index(np.argmax(corr), corr.shape)
+
+    shift = np.zeros(2)
+
+    for axis, size in enumerate((h, w)):
+        shift[axis] = (peak[axis] + size // 2) % size - size // 2
+
+        if subpixel:
+            before = list(peak)
+            after = list(peak)
+            before[axis] = (peak[axis] - 1) % size
+            after[axis] = (peak[axis] + 1) % size
+            left, top, right = corr[tuple(before)], corr[peak], corr[tuple(after)]
+            curvature = left - 2 * top + right
+            if curvature < 0:
+                shift[axis] += 0.5 * (left - right) / curvature
+
+    return shift
+
+
+def shift_image(image, shift, order=1):
+    """Returns a copy of the image translated by shift (rows, columns), with
+    zeros in the area left uncovered.
+    Whole pixel shifts are done by slicing and keep the dtype of the image.
+    Fractional shifts are interpolated by scipy.ndimage.shift with a spline
+    of the given order (1 for images, 0 for labels)"""
+
+    rows, cols = shift
+
+    if float(rows).is_integer() and float(cols).is_integer():
+        rows, cols = int(rows), int(cols)
+        h, w = image.shape[:2]
+        shifted = np.zeros(image.shape, dtype=image.dtype)
+
+        if abs(rows) < h and abs(cols) < w:
+            shifted[max(rows, 0):h + min(rows, 0),
+                    max(cols, 0):w + min(cols, 0)] = \
+                image[max(-rows, 0):h + min(-rows, 0),
+                      max(-cols, 0):w + min(-cols, 0)]
+
+        return shifted
+
+    if order > 0 and not np.issubdtype(image.dtype, np.floating):
+        image = image.astype(float)
+
+    return ndimage.shift(image, (rows, cols), order=order, mode="constant",
+                         cval=0)
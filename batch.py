@@ -0,0 +1,224 @@
+"""Command line entry point used to analyse a batch of fields without the
+GUI.
+Each field is made of a base image, a fluor image and an optional image
+that share the same name and differ only on a suffix, e.g.
+field1_phase.tif, field1_membrane.tif and field1_dna.tif.
+Each field goes through the same steps as an analysis made in the GUI,
+using the parameters saved by ParametersManager.save_parameters, and the
+reports of every field are written to the output folder.
+With --hyperstack each field is instead a single multi-page or hyperstack
+TIFF file with the base, fluor and optional images as channels, set by the
+base channel, fluor channel and optional channel parameters.
+Fields are analysed in parallel by a pool of worker processes.
+
+Usage example:
+python batch.py params.cfg images/ reports/ --workers 4
+python batch.py params.cfg "images/*_phase.tif" reports/
+python batch.py params.cfg "stacks/*.tif" reports/ --hyperstack
+"""
+
+import os
+import sys
+import glob
+import argparse
+import traceback
+import multiprocessing as mp
+from ehooke import EHooke
+
+
+def find_fields(source, base_suffix, fluor_suffix, optional_suffix):
+    """Returns a list of (name, base, fluor, optional) tuples, one for each
+    base image found in source.
+    source can be a folder or a glob pattern matching the base images.
+    The fluor and optional images are expected in the same folder as the base
+    image, with the same name and extension. Fields without a fluor image
+    are skipped and optional is None when there is no optional image."""
+
+    if os.path.isdir(source):
+        pattern = os.path.join(source, "*" + base_suffix + ".*")
+    else:
+        pattern = source
+
+    fields = []
+
+    for base in sorted(glob.glob(pattern)):
+        folder, filename = os.path.split(base)
+        stem, ext = os.path.splitext(filename)
+
+        if not stem.endswith(base_suffix):
+            continue
+
+        name = stem[:len(stem) - len(base_suffix)]
+
+        fluor = os.path.join(folder, name + fluor_suffix + ext)
+        if not os.path.exists(fluor):
+            print("No fluor image for " + base + ", field skipped")
+            continue
+
+        optional = None
+        if optional_suffix:
+            candidate = os.path.join(folder, name + optional_suffix + ext)
+            if os.path.exists(candidate):
+                optional = candidate
+
+        fields.append((name.rstrip("_-. "), base, fluor, optional))
+
+    return fields
+
+
+def find_hyperstacks(source):
+    """Returns a list of (name, hyperstack, None, None) tuples, one for each
+    TIFF file found in source, which can be a folder or a glob pattern."""
+
+    if os.path.isdir(source):
+        files = glob.glob(os.path.join(source, "*.tif")) + \
+            glob.glob(os.path.join(source, "*.tiff"))
+    else:
+        files = glob.glob(source)
+
+    return [(os.path.splitext(os.path.basename(filename))[0], filename,
+             None, None) for filename in sorted(files)]
+
+
+def warm_up_worker(params_file):
+    """Loads the networks needed by the parameters, once per process, so that
+    every field analysed by the process shares them. Used as the
+    initializer of the pool workers. Errors are left to be reported by the
+    analysis of each field"""
+    try:
+        ehooke = EHooke()
+        ehooke.parameters.load_parameters(params_file)
+        ehooke.warm_up_models()
+    except Exception:
+        print("Could not load the networks before the analysis")
+
+
+def analyse_field(task):
+    """Runs the whole analysis of a single field and generates its reports.
+    Without a fluor image the base image is a hyperstack with all the
+    channels of the field.
+    Returns the name of the field and None, or the traceback of the error
+    that stopped the analysis"""
+
+    name, base, fluor, optional, params_file, output, cell_data = task
+
+    try:
+        ehooke = EHooke(cell_data=cell_data)
+        ehooke.parameters.load_parameters(params_file)
+
+        # fields are already processed in parallel and the pool workers
+        # cannot start processes of their own
+        ehooke.parameters.cellprocessingparams.processing_workers = 1
+        ehooke.parameters.imageloaderparams.stardist_tile_workers = 1
+
+        if fluor is None:
+            ehooke.load_hyperstack(base)
+            ehooke.compute_mask()
+        else:
+            ehooke.load_base_image(base)
+            ehooke.compute_mask()
+            ehooke.load_fluor_image(fluor)
+            if optional is not None:
+                ehooke.load_option_image(optional)
+        ehooke.compute_segments()
+        ehooke.compute_cells()
+        ehooke.process_cells()
+        ehooke.generate_reports(output, label=name)
+
+    except Exception:
+        return name, traceback.format_exc()
+
+    return name, None
+
+
+def run_batch(params_file, source, output, workers=1,
+              base_suffix="_phase", fluor_suffix="_membrane",
+              optional_suffix="_dna", cell_data=True, hyperstack=False):
+    """Analyses every field found in source and writes the reports to the
+    output folder, using a pool of workers processes.
+    With hyperstack each file found in source is a field.
+    Returns the list of (name, error) tuples of the fields that failed"""
+
+    if hyperstack:
+        fields = find_hyperstacks(source)
+    else:
+        fields = find_fields(source, base_suffix, fluor_suffix, optional_suffix)
+
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    tasks = [(name, base, fluor, optional, params_file, output, cell_data)
+             for name, base, fluor, optional in fields]
+
+    print("Fields found: " + str(len(tasks)))
+
+    failed = []
+
+    if workers > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(workers, len(tasks)), initializer=warm_up_worker,
+                       initargs=(params_file,))
+        try:
+            results = pool.imap_unordered(analyse_field, tasks)
+            for name, error in results:
+                failed.extend(report_field(name, error))
+        finally:
+            pool.close()
+            pool.join()
+    elif len(tasks) > 0:
+        warm_up_worker(params_file)
+        for task in tasks:
+            name, error = analyse_field(task)
+            failed.extend(report_field(name, error))
+
+    print("Batch Finished: " + str(len(tasks) - len(failed)) + " of " +
+          str(len(tasks)) + " fields analysed")
+
+    return failed
+
+
+def report_field(name, error):
+    """Prints the outcome of a field. Returns a list with the failed field"""
+    if error is None:
+        print("Field Finished: " + name)
+        return []
+
+    print("Field Failed: " + name)
+    print(error)
+    return [(name, error)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyse a batch of fields with eHooke, without the GUI")
+    parser.add_argument("params",
+                        help="parameters file saved by eHooke")
+    parser.add_argument("source",
+                        help="folder or glob pattern of the base images")
+    parser.add_argument("output",
+                        help="folder where the reports are saved")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of fields analysed in parallel")
+    parser.add_argument("--base-suffix", default="_phase",
+                        help="suffix of the base images")
+    parser.add_argument("--fluor-suffix", default="_membrane",
+                        help="suffix of the fluor images")
+    parser.add_argument("--optional-suffix", default="_dna",
+                        help="suffix of the optional images, empty to skip")
+    parser.add_argument("--no-cell-data", action="store_true",
+                        help="do not save the image of each cell")
+    parser.add_argument("--hyperstack", action="store_true",
+                        help="each file in source is a field with all the "
+                             "channels")
+    args = parser.parse_args()
+
+    failed = run_batch(args.params, args.source, args.output, args.workers,
+                       args.base_suffix, args.fluor_suffix,
+                       args.optional_suffix, not args.no_cell_data,
+                       args.hyperstack)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
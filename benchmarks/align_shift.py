@@ -0,0 +1,31 @@
+"""Regression test and micro-benchmark of the Phase Correlation alignment
+against the Correlation one it complements, on the fluor and optional
+test images, as loaded and shifted by known amounts"""
+
+import numpy as np
+
+from common import analyse_test_images, timeit
+import alignment
+from images import read_image, as_float
+
+
+if __name__ == "__main__":
+    app = analyse_test_images()
+    inverted_mask = 1 - app.image_manager.mask
+    spectrum = alignment.mask_spectrum(inverted_mask)
+
+    for filename in ("test_membrane.tif", "test_dna.tif"):
+        image = as_float(read_image(filename), app.parameters.imageloaderparams.precision)
+
+        for moved in ((0, 0), (3, -4), (-7, 2)):
+            shifted = alignment.shift_image(image, moved)
+            correlation, correlation_time = timeit(
+                alignment.correlation_shift, inverted_mask, shifted)
+            phase, phase_time = timeit(
+                alignment.phase_correlation_shift, spectrum, shifted)
+            assert np.array_equal(correlation, phase), \
+                "shifts differ on " + filename + " moved by " + str(moved)
+            print("{} moved by {}: shift {}, Correlation {:.4f} s, "
+                  "Phase Correlation {:.4f} s".format(
+                      filename, moved, tuple(int(v) for v in phase),
+                      correlation_time, phase_time))
@@ -0,0 +1,38 @@
+"""Compares the axes algorithms of Cell.compute_axes with Rotations on the
+cells of the bundled test images: number of cells whose rectangle differs
+from the one of Rotations, largest width difference and time to compute
+the axes of all the cells"""
+
+import numpy as np
+
+from common import analyse_test_images, timeit
+import cellprocessing as cp
+
+
+def rectangles(cells, rotations, algorithm):
+    """Returns the narrowest rectangle of each cell with the algorithm"""
+    return [cell.narrowest_rectangle(np.asarray(cell.outline), rotations, algorithm)
+            for cell in cells]
+
+
+if __name__ == "__main__":
+    app = analyse_test_images()
+    params = app.parameters.cellprocessingparams
+    rotations = cp.rotation_matrices(params.axial_step)
+    cells = list(app.cell_manager.cells.values())
+
+    reference, reference_time = timeit(rectangles, cells, rotations, "Rotations")
+    reference_widths = np.array([cp.bound_rectangle(np.array([[x0, y0], [x1, y1]]))[4]
+                                 for x0, y0, x1, y1, r in reference])
+
+    for algorithm in params.axes_algorithms:
+        result, elapsed = timeit(rectangles, cells, rotations, algorithm)
+        widths = np.array([cp.bound_rectangle(np.array([[x0, y0], [x1, y1]]))[4]
+                           for x0, y0, x1, y1, r in result])
+        differ = sum(not (np.allclose(a[:4], b[:4]) and np.allclose(a[4], b[4]))
+                     for a, b in zip(reference, result))
+        print("{}: {} of {} cells differ from Rotations, width up to {:.2f} px, "
+              "{:.4f} s ({:.1f}x Rotations)".format(
+                  algorithm, differ, len(cells),
+                  np.amax(np.abs(widths - reference_widths)), elapsed,
+                  reference_time / elapsed))
@@ -0,0 +1,97 @@
+"""Benchmark of the vectorized CellManager.cell_regions_from_labels against
+the per-pixel loop it replaced, on the labels of the bundled test images.
+Checks that both give the same lines, outline, neighbours, area and
+perimeter for every cell"""
+
+import numpy as np
+
+from common import analyse_test_images, timeit
+from cells import CellManager
+
+
+def loop_regions(labels, pixel_size):
+    """cell_regions_from_labels before it was vectorized, with the steps of the
+    former Cell.add_line and Cell.add_frontier_point methods inlined.
+    Returns {label: (lines, outline, neighbours, area, perimeter)}"""
+
+    difLabels = []
+    for line in labels:
+        difLabels.extend(set(line))
+    difLabels = sorted(set(difLabels))[1:]
+
+    cells = {}
+    for f in difLabels:
+        cells[int(f)] = ([], [], {}, [0.0])
+
+    for y in range(1, len(labels[0, :]) - 1):
+        old_label = 0
+        x1 = -1
+
+        for x in range(1, len(labels[:, 0]) - 1):
+            l = int(labels[x, y])
+
+            # check if line began or ended, add line
+            if l != old_label:
+                if x1 > 0:
+                    x2 = x - 1
+                    lines, outline, neighbours, area = cells[old_label]
+                    lines.append((y, x1, x2))
+                    area[0] = area[0] + (x2 - x1 + 1) * float(pixel_size) * float(pixel_size)
+                    x1 = -1
+                if l > 0:
+                    x1 = x
+                old_label = l
+
+            # check neighbours
+            if l > 0:
+                lines, outline, neighbours, area = cells[l]
+                nlabels = []
+                notzero = []
+                for row in labels[x - 1:x + 2, y - 1:y + 2]:
+                    for p in row:
+                        if p != l and p not in nlabels:
+                            nlabels.append(p)
+                            if p > 0:
+                                notzero.append(p)
+
+                if nlabels != []:
+                    outline.append((x, y))
+
+                for n in notzero:
+                    neighbours[int(n)] = neighbours.get(int(n), 0) + 1
+
+    return {label: (lines, outline, neighbours, area[0],
+                    len(outline) * float(pixel_size))
+            for label, (lines, outline, neighbours, area) in cells.items()}
+
+
+def vectorized_regions(manager, labels, pixel_size):
+    """Returns the cells of cell_regions_from_labels in the format of
+    loop_regions"""
+    manager.cell_regions_from_labels(labels, pixel_size)
+
+    return {int(c.label): ([tuple(int(v) for v in line) for line in c.lines],
+                           [tuple(int(v) for v in point) for point in c.outline],
+                           {int(n): count for n, count in c.neighbours.items()},
+                           c.stats["Area"], c.stats["Perimeter"])
+            for c in manager.cells.values()}
+
+
+if __name__ == "__main__":
+    app = analyse_test_images()
+    labels = app.segments_manager.labels
+    pixel_size = app.parameters.imageloaderparams.pixel_size
+    manager = CellManager(app.parameters)
+
+    old, old_time = timeit(loop_regions, labels, pixel_size, repeat=1)
+    new, new_time = timeit(vectorized_regions, manager, labels, pixel_size)
+
+    assert sorted(old.keys()) == sorted(new.keys()), "cells differ"
+    for label in old.keys():
+        assert old[label][:3] == new[label][:3], "regions differ for cell {}".format(label)
+        assert np.isclose(old[label][3], new[label][3]), "area differs for cell {}".format(label)
+        assert old[label][4] == new[label][4], "perimeter differs for cell {}".format(label)
+
+    print("{}x{} labels, {} cells: loop {:.3f} s, vectorized {:.4f} s, {:.0f}x".format(
+        labels.shape[0], labels.shape[1], len(old), old_time, new_time,
+        old_time / new_time))
@@ -0,0 +1,67 @@
+"""Benchmark of the batched CellCycleClassifier.classify_cells against the
+per-cell classification it replaced, on the cells of the bundled test
+images. Checks that both give the same phases and times them for a few
+batch sizes. The loading of the network is timed separately"""
+
+import time
+
+import numpy as np
+from skimage.exposure import rescale_intensity
+
+from common import analyse_test_images, timeit
+from cellcycleclassifier import CellCycleClassifier, warm_up_cellcycle_model
+
+MICROSCOPE = "Epifluorescence"
+
+
+def classify_per_cell(classifier, image_manager, cell_manager):
+    """classify_cells before it was batched: one prediction per cell.
+    Returns the phases by cell key"""
+    fluor = image_manager.fluor_image
+    optional = image_manager.optional_image
+    phases = {}
+
+    for k in cell_manager.cells.keys():
+        cell = cell_manager.cells[k]
+
+        x0, y0, x1, y1 = cell.box
+
+        cell_fluor = rescale_intensity(fluor[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
+        cell_optional = rescale_intensity(optional[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
+
+        phases[k] = int(classifier.classify_cell(cell_fluor, cell_optional, MICROSCOPE))
+
+    return phases
+
+
+def classify_batched(classifier, image_manager, cell_manager, batch_size):
+    """Returns the phases by cell key given by classify_cells"""
+    classifier.classify_cells(image_manager, cell_manager, MICROSCOPE, True,
+                              batch_size)
+
+    return {k: int(c.stats["Cell Cycle Phase"])
+            for k, c in cell_manager.cells.items()}
+
+
+if __name__ == "__main__":
+    app = analyse_test_images(process=True)
+    image_manager = app.image_manager
+    cell_manager = app.cell_manager
+    classifier = CellCycleClassifier()
+
+    start = time.perf_counter()
+    warm_up_cellcycle_model()
+    print("model loading: {:.3f} s".format(time.perf_counter() - start))
+
+    reference, per_cell_time = timeit(classify_per_cell, classifier,
+                                      image_manager, cell_manager)
+    print("per cell: {} cells, {:.3f} s".format(len(reference), per_cell_time))
+
+    for batch_size in (1, 32, 256):
+        phases, batched_time = timeit(classify_batched, classifier, image_manager,
+                                      cell_manager, batch_size)
+        assert phases == reference, "phases differ with batch size {}".format(batch_size)
+        print("batch size {}: {:.3f} s, {:.1f}x".format(
+            batch_size, batched_time, per_cell_time / batched_time))
+
+    print("phase counts:", np.bincount(list(reference.values())))
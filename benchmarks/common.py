@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmark scripts: makes the eHooke modules
+importable from the benchmarks folder and runs the analysis of the bundled
+test images (test_phase.tif, test_membrane.tif and test_dna.tif as the
+optional image), so that each benchmark can
+compare an engine with the implementation it replaced on real cells.
+Run the scripts from the root of the repository, e.g.
+python benchmarks/outline_points.py"""
+
+import os
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+os.chdir(REPO)
+
+
+def analyse_test_images(process=False, find_septum=False):
+    """Returns an EHooke instance with the cells of the bundled test images
+    computed, and processed if process is True"""
+    from ehooke import EHooke
+
+    app = EHooke()
+    app.load_base_image("test_phase.tif")
+    app.compute_mask()
+    app.load_fluor_image("test_membrane.tif")
+    app.load_option_image("test_dna.tif")
+    app.compute_segments()
+    app.compute_cells()
+
+    if process:
+        app.parameters.cellprocessingparams.find_septum = find_septum
+        app.parameters.cellprocessingparams.septum_algorithm = "Isodata"
+        app.parameters.cellprocessingparams.classify_cells = False
+        app.process_cells()
+
+    return app
+
+
+def timeit(function, *args, repeat=3):
+    """Returns (result, best time in seconds) of calling function(*args)
+    repeat times"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return result, best
@@ -0,0 +1,92 @@
+"""Benchmark of the KD-tree selection of SegmentsManager.select_peaks,
+used by compute_distance_peaks, against the loop over a placed mask it
+replaced.
+Runs on the mask of the bundled test images and on a synthetic dense
+colony of 2048x2048 pixels, checking that both give the same ordered
+list of centres"""
+
+import numpy as np
+from scipy import ndimage
+from skimage.feature import peak_local_max
+
+from common import analyse_test_images, timeit
+from segments import SegmentsManager
+
+
+def placed_mask_peaks(centers, distance, mindist, minmargin):
+    """SegmentsManager.select_peaks before the KD-tree selection"""
+
+    placedmask = np.ones(distance.shape)
+    lx, ly = distance.shape
+    result = []
+    heights = []
+    circles = []
+
+    for c in centers:
+        x, y = c
+
+        if x >= minmargin and y >= minmargin and x <= lx - minmargin \
+                and y <= ly - minmargin and placedmask[x, y]:
+            placedmask[x - mindist:x + mindist +
+                                   1, y - mindist:y + mindist + 1] = 0
+            s = distance[x, y]
+            circles.append((x, y))
+            heights.append(s)
+
+    ixs = np.argsort(heights)
+    for ix in ixs:
+        result.append(circles[ix])
+
+    return result
+
+
+def dense_colony(size=2048, spacing=14, radius=7, seed=0):
+    """Returns a mask (0 on the cells) of a colony of touching round cells
+    on a jittered grid covering the whole field"""
+    rng = np.random.RandomState(seed)
+    mask = np.ones((size, size))
+    xs, ys = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = xs ** 2 + ys ** 2 <= radius ** 2
+
+    for x in range(radius, size - radius, spacing):
+        for y in range(radius, size - radius, spacing):
+            cx = min(max(x + rng.randint(-2, 3), radius), size - radius - 1)
+            cy = min(max(y + rng.randint(-2, 3), radius), size - radius - 1)
+            window = mask[cx - radius:cx + radius + 1, cy - radius:cy + radius + 1]
+            window[disk] = 0
+
+    return mask
+
+
+def compare(name, mask, params):
+    """Times the selection of the peaks alone, from the same candidates, and
+    the whole compute_distance_peaks"""
+    distance = ndimage.morphology.distance_transform_edt(1 - mask)
+    mindist = params.peak_min_distance
+    minmargin = params.peak_min_distance_from_edge
+    centers = peak_local_max(distance, min_distance=mindist,
+                             threshold_abs=params.peak_min_height,
+                             exclude_border=True,
+                             num_peaks=params.max_peaks,
+                             indices=True)
+
+    old, old_time = timeit(placed_mask_peaks, centers, distance, mindist, minmargin)
+    new, new_time = timeit(SegmentsManager.select_peaks, centers, distance,
+                           mindist, minmargin)
+    _, total_time = timeit(SegmentsManager.compute_distance_peaks, mask, params)
+
+    assert [tuple(int(v) for v in c) for c in old] == \
+        [tuple(int(v) for v in c) for c in new], "centres differ on the " + name
+    print("{}: {} candidates, {} centres, selection with placed mask {:.4f} s, "
+          "with KD-tree {:.4f} s, {:.1f}x (whole compute_distance_peaks {:.3f} s)".format(
+              name, len(centers), len(new), old_time, new_time,
+              old_time / new_time, total_time))
+
+
+if __name__ == "__main__":
+    app = analyse_test_images()
+    params = app.parameters.imageprocessingparams
+    params.max_peaks = 10000
+
+    compare("test image mask", app.image_manager.mask, params)
+    compare("dense colony", dense_colony(), params)
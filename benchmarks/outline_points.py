@@ -0,0 +1,82 @@
+"""Regression test and micro-benchmark of Cell.get_outline_points against
+the per-pixel loop it replaced, on the septum masks of the bundled test
+images (Isodata septum detection) and on random masks"""
+
+import numpy as np
+
+from common import analyse_test_images, timeit
+from cells import Cell
+
+
+def loop_outline_points(data):
+    """Cell.get_outline_points before it was vectorized"""
+    outline = []
+    for x in range(0, len(data)):
+        for y in range(0, len(data[x])):
+            if data[x, y] == 1:
+                if x == 0 and y == 0:
+                    neighs_sum = data[x, y] + data[x + 1, y] + \
+                                 data[x + 1, y + 1] + data[x, y + 1]
+                elif x == len(data) - 1 and y == len(data[x]) - 1:
+                    neighs_sum = data[x, y] + data[x, y - 1] + \
+                                 data[x - 1, y - 1] + data[x - 1, y]
+                elif x == 0 and y == len(data[x]) - 1:
+                    neighs_sum = data[x, y] + data[x, y - 1] + \
+                                 data[x + 1, y - 1] + data[x + 1, y]
+                elif x == len(data) - 1 and y == 0:
+                    neighs_sum = data[x, y] + data[x - 1, y] + \
+                                 data[x - 1, y + 1] + data[x, y + 1]
+                elif x == 0:
+                    neighs_sum = data[x, y] + data[x, y - 1] + data[x, y + 1] + \
+                                 data[x + 1, y - 1] + \
+                                 data[x + 1, y] + data[x + 1, y + 1]
+                elif x == len(data) - 1:
+                    neighs_sum = data[x, y] + data[x, y - 1] + data[x, y + 1] + \
+                                 data[x - 1, y - 1] + \
+                                 data[x - 1, y] + data[x - 1, y + 1]
+                elif y == 0:
+                    neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + \
+                                 data[x - 1, y + 1] + \
+                                 data[x, y + 1] + data[x + 1, y + 1]
+                elif y == len(data[x]) - 1:
+                    neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + \
+                                 data[x - 1, y - 1] + \
+                                 data[x, y - 1] + data[x + 1, y - 1]
+                else:
+                    neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + data[x - 1, y - 1] + data[
+                        x, y - 1] + data[x + 1, y - 1] + data[x - 1, y + 1] + data[x, y + 1] + data[x + 1, y + 1]
+                if neighs_sum != 9:
+                    outline.append((x, y))
+    return outline
+
+
+def random_masks(count=400, seed=0):
+    """Returns random 0/1 float and integer masks of up to 60x60 pixels"""
+    rng = np.random.RandomState(seed)
+    masks = []
+    for ix in range(count):
+        shape = rng.randint(3, 61, size=2)
+        mask = (rng.random_sample(shape) < rng.uniform(0.3, 0.95)).astype(float)
+        masks.append(mask if ix % 2 == 0 else mask.astype(int))
+
+    return masks
+
+
+def compare(name, masks):
+    cell = Cell(0)
+    old, old_time = timeit(lambda: [loop_outline_points(m) for m in masks])
+    new, new_time = timeit(lambda: [cell.get_outline_points(m) for m in masks])
+
+    assert old == new, "outline points differ on the " + name
+    print("{}: {} masks, loop {:.4f} s, vectorized {:.4f} s, {:.1f}x".format(
+        name, len(masks), old_time, new_time, old_time / new_time))
+
+
+if __name__ == "__main__":
+    app = analyse_test_images(process=True, find_septum=True)
+    septa = [np.asarray(c.sept_mask, dtype=float)
+             for c in app.cell_manager.cells.values()
+             if c.sept_mask is not None and np.any(c.sept_mask)]
+
+    compare("test image septa", septa)
+    compare("random masks", random_masks())
@@ -0,0 +1,70 @@
+"""Benchmark of the vectorized Cell.recompute_outline against the loop over
+the outline points it replaced, on merged cells of the bundled test images:
+pairs of neighbouring cells and a single cell made by merging every cell
+of the field. Checks that both give the same outline"""
+
+import numpy as np
+
+from common import analyse_test_images, timeit
+
+
+def loop_outline(cell, labels):
+    """Cell.recompute_outline before it was vectorized, without adding the
+    label of the cell to its merged_list"""
+    ids = list(cell.merged_list)
+    ids.append(cell.label)
+    new_outline = []
+
+    for px in cell.outline:
+        y, x = px
+        neigh_pixels = labels[y - 1:y + 2, x - 1:x + 2].flatten()
+
+        outline_check = False
+
+        for val in neigh_pixels:
+            if val in ids:
+                pass
+            else:
+                outline_check = True
+        if outline_check:
+            new_outline.append(px)
+
+    return np.reshape(np.array(new_outline, dtype=np.int32), (-1, 2))
+
+
+def compare(name, cells, labels):
+    old, old_time = timeit(lambda: [loop_outline(c, labels) for c in cells])
+    new, new_time = timeit(lambda: [c.recompute_outline(labels) for c in cells])
+
+    assert all(np.array_equal(a, b) for a, b in zip(old, new)), \
+        "outlines differ on the " + name
+    print("{}: {} cells, {} outline points, loop {:.4f} s, vectorized {:.4f} s, "
+          "{:.0f}x".format(name, len(cells), sum(len(c.outline) for c in cells),
+                           old_time, new_time, old_time / new_time))
+
+
+if __name__ == "__main__":
+    app = analyse_test_images()
+    manager = app.cell_manager
+    labels = app.segments_manager.labels
+
+    # merges cells with a neighbour in pairs, leaving the outlines to
+    # recompute
+    pairs = []
+    used = set()
+    for k in sorted(manager.cells.keys(), key=int):
+        if k in used:
+            continue
+        for n in manager.cells[k].neighbours.keys():
+            n = str(int(n))
+            if n in manager.cells and n not in used and n != k:
+                manager.join_cells(int(n), int(k), labels)
+                pairs.append(k)
+                used.update((k, n))
+                break
+    compare("merged pairs", [manager.cells[k] for k in pairs], labels)
+
+    keys = sorted(manager.cells.keys(), key=int)
+    for k in keys[1:]:
+        manager.join_cells(int(k), int(keys[0]), labels)
+    compare("whole field merged", [manager.cells[keys[0]]], labels)
@@ -10,11 +10,39 @@ import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 
 
-class CellCycleClassifier(object):
+# cell cycle network shared by every CellCycleClassifier of this process
+cellcycle_model = None
+
+
+def get_cellcycle_model():
+    """Returns the cell cycle network, loading it from disk only the first
+    time it is needed in this process"""
+    global cellcycle_model
+
+    if cellcycle_model is None:
+        cellcycle_model = load_model("cellcycle_cnn_model")
+
+    return cellcycle_model
+
+
+def warm_up_cellcycle_model():
+    """Loads the cell cycle network ahead of the first classification"""
+    get_cellcycle_model()
+
+
+def release_cellcycle_model():
+    """Releases the cell cycle network. It is loaded again on the next
+    classification"""
+    global cellcycle_model
+    cellcycle_model = None
+
 
-    def __init__(self):
+class CellCycleClassifier(object):
 
-        self.model = load_model("cellcycle_cnn_model")
+    @property
+    def model(self):
+        """The cell cycle network shared by the whole process"""
+        return get_cellcycle_model()
 
     def preprocess_image(self, image, microscope):
 
@@ -70,7 +98,9 @@ class CellCycleClassifier(object):
 
         return image
 
-    def classify_cell(self, fluor, optional, microscope):
+    def preprocess_cell(self, fluor, optional, microscope):
+        """Returns the 100x200 network input of a cell, with the fluor and
+        optional crops side by side"""
 
         fluor_img = skresize(self.preprocess_image(fluor, microscope),
                              (100, 100),
@@ -86,11 +116,20 @@ class CellCycleClassifier(object):
                                 anti_aliasing=False,
                                 anti_aliasing_sigma=None)
 
-        pred = self.model.predict_classes(np.concatenate((fluor_img, optional_img), axis=1).reshape(-1, 100, 200, 1))
+        return np.concatenate((fluor_img, optional_img), axis=1)
+
+    def classify_cell(self, fluor, optional, microscope):
+
+        cell_img = self.preprocess_cell(fluor, optional, microscope)
+
+        pred = self.model.predict_classes(cell_img.reshape(-1, 100, 200, 1))
 
         return pred[0] + 1
 
-    def classify_cells(self, image_manager, cell_manager, microscope, secondary):
+    def classify_cells(self, image_manager, cell_manager, microscope, secondary, batch_size=256):
+        """Classifies all the cells of the cell_manager.
+        The cells are preprocessed and sent to the network in batches of
+        batch_size cells, instead of running one prediction per cell"""
         fluor = image_manager.fluor_image
 
         if image_manager.optional_image is not None and secondary == True:
@@ -99,12 +138,23 @@ class CellCycleClassifier(object):
             print("No optional image provided, using dummy optional image")
             optional = np.ones(fluor.shape)
 
-        for k in cell_manager.cells.keys():
-            cell = cell_manager.cells[k]
+        keys = list(cell_manager.cells.keys())
+
+        for start in range(0, len(keys), batch_size):
+            batch_keys = keys[start:start + batch_size]
+            batch = np.zeros((len(batch_keys), 100, 200, 1))
+
+            for i, k in enumerate(batch_keys):
+                cell = cell_manager.cells[k]
+
+                x0, y0, x1, y1 = cell.box
+
+                cell_fluor = rescale_intensity(fluor[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
+                cell_optional = rescale_intensity(optional[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
 
-            x0, y0, x1, y1 = cell.box
+                batch[i] = self.preprocess_cell(cell_fluor, cell_optional, microscope)
 
-            cell_fluor = rescale_intensity(fluor[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
-            cell_optional = rescale_intensity(optional[x0:x1 + 1, y0:y1 + 1] * cell.cell_mask)
+            pred = self.model.predict_classes(batch, batch_size=batch_size)
 
-            cell_manager.cells[k].stats["Cell Cycle Phase"] = self.classify_cell(cell_fluor, cell_optional, microscope)
+            for k, phase in zip(batch_keys, pred):
+                cell_manager.cells[k].stats["Cell Cycle Phase"] = phase + 1
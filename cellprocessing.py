@@ -2,29 +2,124 @@
 
 import cells
 import numpy as np
-from skimage import color
+from scipy.spatial import ConvexHull
+from skimage import color, morphology
 from skimage.util import img_as_int
 from skimage.segmentation import mark_boundaries
 
 
+# rotation matrices already computed, by step
+rotation_cache = {}
+
+
 def rotation_matrices(step):
-    """ returns a list of rotation matrixes over 180 deg
+    """ returns a k,2,2 array with the rotation matrixes over 180 deg
     matrixes are transposed to use with 2 column point arrays (x,y),
-    multiplying after the array
-    TODO: optimize with np vectors
+    multiplying after the array.
+    the array is computed once per step and is read only
     """
 
-    result = []
-    ang = 0
+    if step not in rotation_cache:
+        angles = []
+        ang = 0
 
-    while ang < 180:
-        sa = np.sin(ang / 180.0 * np.pi)
-        ca = np.cos(ang / 180.0 * np.pi)
-        # note .T, for column points
-        result.append(np.matrix([[ca, -sa], [sa, ca]]).T)
-        ang = ang + step
+        while ang < 180:
+            angles.append(ang)
+            ang = ang + step
+
+        result = rotation_stack(angles)
+        result.flags.writeable = False
+        rotation_cache[step] = result
+
+    return rotation_cache[step]
 
-    return result
+
+def rotation_stack(angles):
+    """ returns a k,2,2 array with the rotation matrices of the angles, in
+    degrees, transposed as the ones returned by rotation_matrices
+    """
+
+    rad = np.asarray(angles, dtype=float) / 180.0 * np.pi
+    sa = np.sin(rad)
+    ca = np.cos(rad)
+
+    return np.stack([np.stack([ca, sa], axis=-1),
+                     np.stack([-sa, ca], axis=-1)], axis=-2)
+
+
+def convex_hull(points):
+    """ returns the vertices of the convex hull of a N,2 array of points.
+    when all the points are on a line the two extremes are returned
+    """
+
+    points = np.asarray(points, dtype=float)
+    centered = points - points[0]
+
+    if len(points) < 3 or np.linalg.matrix_rank(centered) < 2:
+        direction = centered[np.argmax(np.abs(centered).sum(axis=1))]
+        projection = np.dot(centered, direction)
+        return points[[np.argmin(projection), np.argmax(projection)]]
+
+    return points[ConvexHull(points).vertices]
+
+
+def caliper_angle(points):
+    """ returns the angle, in degrees in [0, 90), of the rotation giving the
+    narrowest bounding rectangle of the points.
+    the narrowest rectangle has one side on an edge of the convex hull
+    (rotating calipers), so only the rotations that align each hull edge
+    with the axes need to be checked
+    """
+
+    hull = convex_hull(points)
+    edges = np.roll(hull, -1, axis=0) - hull
+    angles = np.degrees(np.arctan2(-edges[:, 1], edges[:, 0])) % 90.0
+
+    rotated = np.einsum("nj,kjm->knm", hull, rotation_stack(angles))
+    extents = np.amax(rotated, axis=1) - np.amin(rotated, axis=1)
+
+    return angles[np.argmin(np.amin(extents, axis=1))]
+
+
+def narrowest_rotation(points, rotations):
+    """ returns (x0, y0, x1, y1, rix) of the narrowest bounding rectangle of
+    the points over the given rotations, where rix is the index of the
+    rotation. the first of equally narrow rectangles is kept
+    """
+
+    width = np.inf
+
+    for rix in range(len(rotations)):
+        r = rotations[rix]
+        nx0, ny0, nx1, ny1, nwidth = bound_rectangle(
+            np.asarray(np.dot(points, r)))
+
+        if nwidth < width:
+            width = nwidth
+            x0 = nx0
+            x1 = nx1
+            y0 = ny0
+            y1 = ny1
+            angle = rix
+
+    return x0, y0, x1, y1, angle
+
+
+def batched_rotation(points, rotations):
+    """ same as narrowest_rotation, but projects the points with all the
+    rotations at once, from a k,2,2 array of rotations
+    """
+
+    rotated = np.matmul(np.asarray(points, dtype=float), rotations)
+    mins = np.amin(rotated, axis=1)
+    maxs = np.amax(rotated, axis=1)
+    widths = np.amin(maxs - mins, axis=1)
+    rix = int(np.argmin(widths))
+
+    x0, y0 = mins[rix]
+    x1, y1 = maxs[rix]
+
+    return x0, y0, x1, y1, rix
 
 
 def bounded_value(minval, maxval, currval):
@@ -59,6 +154,173 @@ def bound_rectangle(points):
     return x0, y0, x1, y1, a
 
 
+def label_lines(labels):
+    """ returns an (N, 4) array with the (label, y, x1, x2) of each vertical
+    run of labelled pixels inside the one pixel border of the image.
+    runs are ordered as in a column by column scan and runs that only end
+    at the last scanned pixel of a column are left open (not returned)
+    """
+
+    # one image column per row, so that runs are contiguous in memory
+    inner = np.ascontiguousarray(np.asarray(labels)[1:-1, 1:-1].T)
+
+    if inner.size == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    previous = np.zeros_like(inner)
+    previous[:, 1:] = inner[:, :-1]
+
+    changes = np.flatnonzero(inner != previous)
+    ncols = inner.shape[1]
+    flat = inner.ravel()
+
+    starts = changes[:-1]
+    ends = changes[1:]
+    closed = (flat[starts] > 0) & (starts // ncols == ends // ncols)
+    starts = starts[closed]
+    ends = ends[closed]
+
+    result = np.empty((len(starts), 4), dtype=np.int64)
+    result[:, 0] = flat[starts]
+    result[:, 1] = starts // ncols + 1
+    result[:, 2] = starts % ncols + 1
+    result[:, 3] = ends % ncols
+
+    return result
+
+
+def label_frontiers(labels):
+    """ returns the frontier pixels of every label and the neighbour contacts
+    of each frontier pixel, checking the 3x3 neighbourhood of every pixel
+    inside the one pixel border.
+    returns (outline, contacts): outline is an (N, 3) array of
+    (label, x, y) in column by column scan order and contacts is an (M, 2)
+    array of the (label, neighbour) pairs found in each neighbourhood, with
+    each distinct neighbour counted once per pixel and the pairs ordered by
+    first occurrence
+    """
+
+    labels = np.asarray(labels)
+    h, w = labels.shape
+    offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+               if dx != 0 or dy != 0]
+
+    inner = labels[1:h - 1, 1:w - 1]
+    frontier = np.zeros(inner.shape, dtype=bool)
+    for dx, dy in offsets:
+        frontier |= inner != labels[1 + dx:h - 1 + dx, 1 + dy:w - 1 + dy]
+    frontier &= inner > 0
+
+    # transposed so that points come out in the column by column order
+    ys, xs = np.nonzero(frontier.T)
+    xs = xs + 1
+    ys = ys + 1
+    owners = labels[xs, ys]
+
+    outline = np.empty((len(xs), 3), dtype=np.int64)
+    outline[:, 0] = owners
+    outline[:, 1] = xs
+    outline[:, 2] = ys
+
+    neighs = np.stack([labels[xs + dx, ys + dy] for dx, dy in offsets],
+                      axis=1)
+    valid = (neighs != owners[:, None]) & (neighs > 0)
+    for ix in range(1, len(offsets)):
+        repeated = np.any(neighs[:, :ix] == neighs[:, ix:ix + 1], axis=1)
+        valid[:, ix] &= ~repeated
+
+    rows, cols = np.nonzero(valid)
+    contacts = np.empty((len(rows), 2), dtype=neighs.dtype)
+    contacts[:, 0] = owners[rows]
+    contacts[:, 1] = neighs[rows, cols]
+
+    return outline, contacts
+
+
+def background_mask(mask):
+    """ returns the background of the whole image used for the baseline of
+    the cells: the mask (0 at cells, 1 outside) with the cells dilated once
+    by a diamond of radius 5, the same as the five cross dilations done in
+    Cell.compute_fluor_baseline """
+
+    inverted = (1 - np.asarray(mask)) != 0
+    dilated = morphology.binary_dilation(inverted, morphology.diamond(5))
+
+    return np.logical_not(dilated)
+
+
+def region_values(cells, name, image):
+    """ returns (groups, values, missing) with the values of the image inside
+    the region mask of each cell, stored in the cell attribute name in the
+    coordinates of cell.box.
+    groups is the index of the cell of each value and the values are
+    multiplied by the mask, as in Cell.measure_fluor. missing flags the
+    cells without the mask.
+    the masks of different cells may overlap, so each cell keeps its own
+    pixels instead of sharing a single label image
+    """
+
+    width = image.shape[1]
+    groups = [np.zeros(0, dtype=int)]
+    indexes = [np.zeros(0, dtype=int)]
+    weights = [np.zeros(0)]
+    missing = np.zeros(len(cells), dtype=bool)
+
+    for ix, c in enumerate(cells):
+        roi = getattr(c, name)
+        if roi is None:
+            missing[ix] = True
+            continue
+
+        x0, y0, x1, y1 = c.box
+        xs, ys = np.nonzero(roi > 0.5)
+        groups.append(np.full(len(xs), ix, dtype=int))
+        indexes.append((xs + x0) * width + ys + y0)
+        weights.append(roi[xs, ys])
+
+    groups = np.concatenate(groups)
+    values = np.asarray(image).ravel()[np.concatenate(indexes)] * \
+        np.concatenate(weights)
+
+    return groups, values, missing
+
+
+def grouped_medians(groups, values, ngroups, fraction=1.0):
+    """ returns the median of the values of each group, as
+    Cell.measure_fluor for a single region: groups with less than 1/fraction
+    values get 0 and, when fraction < 1, the median is taken over that
+    fraction of the highest non zero values (nan if none is left).
+    the values are sorted once, for all the groups
+    """
+
+    order = np.lexsort((-values, groups))
+    groups = groups[order]
+    values = values[order]
+
+    counts = np.bincount(groups, minlength=ngroups)
+    valid = counts * fraction >= 1.0
+
+    if fraction < 1:
+        nonzero = values != 0
+        groups = groups[nonzero]
+        values = values[nonzero]
+        taken = (np.bincount(groups, minlength=ngroups) * fraction).astype(int)
+    else:
+        taken = counts
+
+    starts = np.searchsorted(groups, np.arange(ngroups))
+
+    result = np.zeros(ngroups)
+    result[valid & (taken == 0)] = np.nan
+
+    sel = np.flatnonzero(valid & (taken > 0))
+    low = values[starts[sel] + (taken[sel] - 1) // 2]
+    high = values[starts[sel] + taken[sel] // 2]
+    result[sel] = np.where(taken[sel] % 2 == 1, low, (low + high) / 2)
+
+    return result
+
+
 def stats_format(params):
     """Returns the list of cell stats to be displayed on the report,
     depending on the computation of the septum"""
@@ -97,71 +359,143 @@ def overlay_cells(cells, image, colors):
     "Overlay the edges of each individual cell in the provided image"
 
     tmp = color.gray2rgb(image)
+    draw_cells(cells, list(cells.keys()), tmp, colors)
 
-    for k in cells.keys():
+    return tmp
+
+
+def draw_cells(cells, keys, image, colors, region=None):
+    """ draws the outline and the septum of the selected cells over the rgb
+    image, in place. when a region (x0, y0, x1, y1) is given only the pixels
+    inside it are changed
+    """
+
+    if region is None:
+        rx0, ry0, rx1, ry1 = 0, 0, image.shape[0] - 1, image.shape[1] - 1
+    else:
+        rx0, ry0, rx1, ry1 = region
+
+    for k in keys:
         c = cells[k]
         if c.selection_state == 1:
             col = colors[c.color_i][:3]
 
-            for px in c.outline:
-                x, y = px
-                tmp[x, y] = col
+            if len(c.outline) > 0:
+                px = np.asarray(c.outline)
+                inside = (px[:, 0] >= rx0) & (px[:, 0] <= rx1) & \
+                         (px[:, 1] >= ry0) & (px[:, 1] <= ry1)
+                image[px[inside, 0], px[inside, 1]] = col
 
             if c.sept_mask is not None:
                 try:
                     x0, y0, x1, y1 = c.box
-                    tmp[x0:x1+1, y0:y1+1] = mark_boundaries(tmp[x0:x1+1, y0:y1+1],
-                                                        img_as_int(
-                                                            c.sept_mask),
-                                                        color=col)
+                    marked = mark_boundaries(image[x0:x1+1, y0:y1+1],
+                                             img_as_int(c.sept_mask),
+                                             color=col)
+                    ix0, iy0 = max(x0, rx0), max(y0, ry0)
+                    ix1, iy1 = min(x1, rx1), min(y1, ry1)
+                    if ix0 <= ix1 and iy0 <= iy1:
+                        image[ix0:ix1+1, iy0:iy1+1] = \
+                            marked[ix0-x0:ix1-x0+1, iy0-y0:iy1-y0+1]
                 except IndexError:
                     c.selection_state = -1
 
-    return tmp
 
+def cell_state(cell):
+    """ returns a tuple that changes whenever the way the cell is painted on
+    the label map or drawn on the overlays changes """
+
+    return (cell.version, cell.label, cell.selection_state, cell.color_i,
+            cell.box)
+
+
+def cell_extent(cell):
+    """ returns the (x0, y0, x1, y1) rectangle with every pixel painted or
+    drawn for the cell, or None if the cell has no pixels """
+
+    xs = []
+    ys = []
+
+    if cell.box is not None:
+        x0, y0, x1, y1 = cell.box
+        xs.extend([x0, x1])
+        ys.extend([y0, y1])
+
+    if len(cell.outline) > 0:
+        points = np.asarray(cell.outline)
+        xs.extend([np.amin(points[:, 0]), np.amax(points[:, 0])])
+        ys.extend([np.amin(points[:, 1]), np.amax(points[:, 1])])
+
+    if len(cell.lines) > 0:
+        lines = np.asarray(cell.lines)
+        xs.extend([np.amin(lines[:, 1]), np.amax(lines[:, 2])])
+        ys.extend([np.amin(lines[:, 0]), np.amax(lines[:, 0])])
+
+    if len(xs) == 0:
+        return None
+
+    return int(min(xs)), int(min(ys)), int(max(xs)), int(max(ys))
 
-def assign_cell_color(cell, cells, cell_colors, pixel_size):
-    """ assigns an index to cell.color that is different from the neighbours """
 
-    neighcols = []
+def preferred_colors(areas, pixel_size, n_colors):
+    """ returns the colour index preferred by each cell, from its area in
+    pixels """
 
-    for neigh in list(iter(cell.neighbours.keys())):
-        try:
-            col = cells[str(int(neigh))].color_i
-            if col not in neighcols:
-                neighcols.append(col)
-        except KeyError:
-            print("Neighbour already merged")
+    return (areas / float(pixel_size) / float(pixel_size) % n_colors).astype(int)
 
-    cell.color_i = int(cell.stats["Area"] / float(pixel_size) / float(pixel_size) % len(cell_colors))  # each cell has a preferred color
 
-    while len(neighcols) < len(cell_colors) and (cell.color_i in neighcols):
-        cell.color_i += 1
+def greedy_colors(graph, rows, preferred, colors, n_colors):
+    """ assigns, in order, a colour index to each of the rows of the
+    adjacency matrix graph (CSR) that differs from the colours of its
+    neighbours: the first free colour from the preferred one of the row, or
+    the preferred one if all are taken.
+    colors holds the colour of every row (-1 for none) and is updated in
+    place.
+    each row depends on the colours given to the rows before it, so the
+    rows are coloured one by one, over lists, which is faster than numpy
+    for the few neighbours of each row """
 
-        if cell.color_i >= len(cell_colors):
-            cell.color_i = 0
+    indptr = graph.indptr.tolist()
+    indices = graph.indices.tolist()
+    assigned = colors.tolist()
+    preferred = preferred.tolist()
 
+    for row in rows:
+        used = {assigned[n] for n in indices[indptr[row]:indptr[row + 1]]}
+        assigned[row] = preferred[row]
+        for step in range(n_colors):
+            if (preferred[row] + step) % n_colors not in used:
+                assigned[row] = (preferred[row] + step) % n_colors
+                break
 
-def update_neighbours(cells, oldlabel, newlabel):
-    """ updates the neighbour list when merging cells """
-    oc = cells[str(oldlabel)]
-    nc = cells[str(newlabel)]
+    colors[:] = assigned
 
-    for nei in oc.neighbours.iterkeys():
+    return colors
 
-        tc = cells[str(int(nei))]
-        inter = tc.neighbours[oldlabel]
-        del tc.neighbours[oldlabel]
 
-        if int(nei) != newlabel:
+def color_clashes(graph, colors):
+    """ returns a boolean array with the rows of the adjacency matrix graph
+    (CSR) without a colour (-1) or with the colour of one of their
+    neighbours """
 
-            if newlabel in tc.neighbours:
-                tc.neighbours[newlabel] = tc.neighbours[newlabel] + inter
-                nc.neighbours[tc.label] = nc.neighbours[tc.label] + inter
+    coo = graph.tocoo()
+    same = (colors[coo.row] == colors[coo.col]) & (colors[coo.row] >= 0)
 
-            else:
-                tc.neighbours[newlabel] = inter
-                nc.neighbours[tc.label] = inter
+    return (colors < 0) | (np.bincount(coo.row[same], minlength=graph.shape[0]) > 0)
+
+
+def merge_candidates(areas, neighbour_areas, interfaces, params):
+    """ returns a boolean array with the cells that can pass check_merge with
+    their best neighbour, from the areas of both and the length of their
+    interface as found on the labels. Areas only grow with merges, so the
+    other cells can be skipped """
+
+    force = params.cellprocessingparams.cell_force_merge_below
+    dividing = params.cellprocessingparams.merge_dividing_cells and \
+        interfaces >= params.cellprocessingparams.merge_min_interface
+
+    return (interfaces > 0) & (areas > 0) & (neighbour_areas > 0) & \
+        ((areas < force) | (neighbour_areas < force) | dividing)
 
 
 def check_merge(cell1, cell2, rotations, interface, mask, params):
@@ -178,12 +512,11 @@ def check_merge(cell1, cell2, rotations, interface, mask, params):
     if params.cellprocessingparams.merge_dividing_cells and \
             interface >= params.cellprocessingparams.merge_min_interface:
         tmp = cells.Cell(0)
-        tmp.outline.extend(cell1.outline)
-        tmp.outline.extend(cell2.outline)
-        tmp.lines.extend(cell1.lines)
-        tmp.lines.extend(cell2.lines)
+        tmp.outline = np.concatenate((cell1.outline, cell2.outline))
+        tmp.lines = np.concatenate((cell1.lines, cell2.lines))
         tmp.stats["Area"] = cell1.stats["Area"] + cell2.stats["Area"]
-        tmp.compute_axes(rotations, mask.shape, params.imageloaderparams.pixel_size)
+        tmp.compute_axes(rotations, mask.shape, params.imageloaderparams.pixel_size,
+                         params.cellprocessingparams.axes_algorithm)
         tmpshort = tmp.stats["Width"]
         maxshort = max(cell1.stats["Width"], cell2.stats["Width"])
 
@@ -207,6 +540,22 @@ def paint_cell(cell, image, newval):
     return image
 
 
+def paint_cells_region(cells, keys, image, region):
+    """ paints the lines of the cells into the image, only inside the
+    region (x0, y0, x1, y1) """
+
+    rx0, ry0, rx1, ry1 = region
+
+    for k in keys:
+        c = cells[k]
+        for li in c.lines:
+            y, x0, x1 = li
+            if ry0 <= y <= ry1 and x1 >= rx0 and x0 <= rx1:
+                image[max(x0, rx0):min(x1, rx1) + 1, y] = c.label
+
+    return image
+
+
 def blocked_by_filter(cell, list_of_filters):
     """ returns true if cell is blocked by any filter
         [("stat", min, max), ("stat2", min, max)]
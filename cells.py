@@ -4,10 +4,11 @@ Contains a class Cell that works as the template for each cell object
 and a CellManager class that controls the different steps of the cell
 processing."""
 
-from collections import OrderedDict
+import itertools
+import multiprocessing as mp
 import numpy as np
 import matplotlib as plt
-from copy import deepcopy
+from scipy.sparse import csr_matrix
 from skimage.draw import line
 from skimage.measure import label
 from skimage.filters import threshold_isodata
@@ -16,18 +17,325 @@ from skimage import morphology, color, exposure
 import cellprocessing as cp
 
 
+# images of the field being processed, set in each worker process of
+# CellManager.process_cells_parallel
+worker_images = None
+worker_params = None
+
+
+class SharedImages(object):
+    """Read-only stand-in for the ImageManager inside the worker processes.
+    Holds the images used by Cell.compute_regions and
+    Cell.compute_fluor_stats as arrays backed by shared memory."""
+
+    names = ["base_image", "fluor_image", "original_fluor_image",
+             "optional_image", "mask"]
+
+    def __init__(self, buffers):
+        for name in self.names:
+            setattr(self, name, None)
+        self.background = None
+
+        for name in buffers.keys():
+            buf, dtype, shape = buffers[name]
+            setattr(self, name,
+                    np.frombuffer(buf, dtype=dtype).reshape(shape))
+
+    @staticmethod
+    def share(image_manager, background=None):
+        """Copies the images of the image_manager, and the background mask
+        of the baseline if given, to shared memory.
+        Returns the dict of buffers to send to the worker processes"""
+        buffers = {}
+        images = [(name, getattr(image_manager, name))
+                  for name in SharedImages.names]
+        images.append(("background", background))
+
+        for name, image in images:
+            if image is not None:
+                image = np.asarray(image)
+                buf = mp.RawArray("b", image.nbytes)
+                np.frombuffer(buf, dtype=image.dtype).reshape(image.shape)[...] = image
+                buffers[name] = (buf, image.dtype.str, image.shape)
+
+        return buffers
+
+
+def init_worker(buffers, params):
+    """Initializer of the process_cells worker processes"""
+    global worker_images, worker_params
+    worker_images = SharedImages(buffers)
+    worker_params = params
+
+
+def process_cell(cell):
+    """Computes the regions and fluorescence stats of a single cell inside a
+    worker process. Returns None if the cell could not be processed"""
+    try:
+        cell.compute_regions(worker_params, worker_images)
+        if worker_params.fluor_stats_algorithm == "Whole Image":
+            cell.compute_fluor_baseline(worker_images.mask,
+                                        worker_images.original_fluor_image,
+                                        worker_params.baseline_margin,
+                                        worker_images.background)
+        else:
+            cell.compute_fluor_stats(worker_params, worker_images,
+                                     worker_images.background)
+    except TypeError:
+        return None
+
+    return cell
+
+
+# name and dtype of the stats of each cell, in the order of the reports
+stats_dtype = np.dtype([("Area", float),
+                        ("Perimeter", float),
+                        ("Length", float),
+                        ("Width", float),
+                        ("Eccentricity", float),
+                        ("Irregularity", float),
+                        ("Neighbours", int),
+                        ("Baseline", float),
+                        ("Cell Median", float),
+                        ("Membrane Median", float),
+                        ("Septum Median", float),
+                        ("Cytoplasm Median", float),
+                        ("Full Septum Median", float),
+                        ("Full Septum Median 75%", float),
+                        ("Full Septum Median 25%", float),
+                        ("Full Septum Median 10%", float),
+                        ("Early Sept Median", float),
+                        ("Fluor Ratio", float),
+                        ("Fluor Ratio 75%", float),
+                        ("Fluor Ratio 25%", float),
+                        ("Fluor Ratio 10%", float),
+                        ("Memb+Sept Median", float),
+                        ("Cell Cycle Phase", int)])
+
+
+class CellStats(object):
+    """Stats of a cell, used like the dict of stats it replaces
+    (cell.stats["Area"]). The values are kept on a record of a structured
+    array with stats_dtype: a row of the CellTable of the CellManager, or
+    a row of its own for cells outside of a table"""
+
+    __slots__ = ("record",)
+
+    def __init__(self, record=None):
+        if record is None:
+            record = np.zeros(1, dtype=stats_dtype)[0]
+        self.record = record
+
+    def __getstate__(self):
+        # an unpickled record is not writable, so a row is pickled instead
+        return np.array([self.record], dtype=stats_dtype)
+
+    def __setstate__(self, state):
+        self.record = state[0]
+
+    def __getitem__(self, key):
+        return self.record[key].item()
+
+    def __setitem__(self, key, value):
+        self.record[key] = value
+
+    def __contains__(self, key):
+        return key in stats_dtype.names
+
+    def __iter__(self):
+        return iter(stats_dtype.names)
+
+    def __len__(self):
+        return len(stats_dtype.names)
+
+    def keys(self):
+        return list(stats_dtype.names)
+
+    def values(self):
+        return [self[key] for key in stats_dtype.names]
+
+    def items(self):
+        return [(key, self[key]) for key in stats_dtype.names]
+
+
+# version numbers given to the cells by Cell.touch, never reused
+cell_versions = itertools.count(1)
+
+
+class CompactMask(object):
+    """Region mask of a Cell (cell_mask, perim_mask, ...).
+    The masks only hold small integer values, 0/1 or up to 2 for the full
+    septum, so 0/1 masks are stored packed to one bit per pixel and the
+    others as uint8. They are converted back to the dtype they were set with
+    when read.
+    Setting a mask that is drawn on the overlays (drawn=True) gives the cell
+    a new version"""
+
+    def __init__(self, name, drawn=False):
+        self.slot = "_" + name
+        self.drawn = drawn
+
+    def __get__(self, cell, owner):
+        if cell is None:
+            return self
+
+        stored = getattr(cell, self.slot)
+        if stored is None:
+            return None
+
+        values, shape, dtype = stored
+        if values.ndim == 1:
+            values = np.unpackbits(values, count=int(np.prod(shape))).reshape(shape)
+
+        if dtype == bool:
+            return values.view(bool)
+
+        return values.astype(dtype)
+
+    def __set__(self, cell, mask):
+        if mask is None:
+            setattr(cell, self.slot, None)
+            if self.drawn:
+                cell.touch()
+            return
+
+        mask = np.asarray(mask)
+        values = mask.astype(np.uint8)
+        if values.max(initial=0) <= 1:
+            values = np.packbits(values, axis=None)
+
+        setattr(cell, self.slot, (values, mask.shape, mask.dtype))
+        if self.drawn:
+            cell.touch()
+
+
+class CellTable(object):
+    """Columnar store of the cells found on a label image, with one row per
+    label (in increasing order):
+    stats is a structured array with stats_dtype and lines (y, x1, x2) and
+    outline (x, y) are int32 arrays grouped by cell, with the rows of the
+    cell ix between offsets[ix] and offsets[ix + 1].
+    The cells created by cell() are views over their row: writing to their
+    stats writes to the table and their lines and outline are slices of the
+    table arrays. The rows of removed cells are left unused.
+    The region adjacency graph of the labels is kept the same way, with the
+    neighbour labels and interface lengths of the row ix between
+    neighbour_offsets[ix] and neighbour_offsets[ix + 1], in the order they
+    were first found."""
+
+    def __init__(self, labels, lines, line_offsets, outline, outline_offsets):
+        self.labels = labels
+        self.stats = np.zeros(len(labels), dtype=stats_dtype)
+        self.lines = lines
+        self.line_offsets = line_offsets
+        self.outline = outline
+        self.outline_offsets = outline_offsets
+        self.neighbours = np.zeros(0, dtype=labels.dtype)
+        self.interfaces = np.zeros(0, dtype=int)
+        self.neighbour_offsets = np.zeros(len(labels) + 1, dtype=int)
+
+    def row(self, label):
+        """Returns the row of the label, or None if it is not on the table"""
+        row = np.searchsorted(self.labels, int(label))
+        if row < len(self.labels) and self.labels[row] == int(label):
+            return row
+        return None
+
+    def cell(self, row):
+        """Creates the cell of the row, backed by the table"""
+        cell = Cell(self.labels[row])
+        cell.stats = CellStats(self.stats[row])
+        cell.lines = self.lines[self.line_offsets[row]:self.line_offsets[row + 1]]
+        cell.outline = \
+            self.outline[self.outline_offsets[row]:self.outline_offsets[row + 1]]
+        return cell
+
+    def set_neighbours(self, contacts):
+        """Builds the adjacency graph from the (label, neighbour) contacts
+        found on the frontier pixels, with the interface between two cells
+        being the number of frontier pixels of the first touching the
+        second"""
+        if len(contacts) == 0:
+            return
+
+        pairs, first, counts = np.unique(contacts, axis=0, return_index=True,
+                                         return_counts=True)
+        keep = np.isin(pairs[:, 0], self.labels)
+        pairs, first, counts = pairs[keep], first[keep], counts[keep]
+
+        rows = np.searchsorted(self.labels, pairs[:, 0])
+        order = np.lexsort((first, rows))
+        self.neighbours = pairs[order, 1]
+        self.interfaces = counts[order]
+        self.neighbour_offsets = np.searchsorted(rows[order],
+                                                 np.arange(len(self.labels) + 1))
+
+    def neighbour_dict(self, row):
+        """Returns the {neighbour: interface} dict of the row"""
+        start, end = self.neighbour_offsets[row], self.neighbour_offsets[row + 1]
+        return dict(zip(self.neighbours[start:end],
+                        self.interfaces[start:end].tolist()))
+
+    def best_neighbours(self):
+        """Returns the label of the neighbour with the longest interface of
+        every row and that interface, the first found on ties, or 0 and 0 for
+        the cells without neighbours"""
+        best = np.zeros(len(self.labels), dtype=self.labels.dtype)
+        interface = np.zeros(len(self.labels), dtype=int)
+        if len(self.neighbours) == 0:
+            return best, interface
+
+        rows = np.repeat(np.arange(len(self.labels)), np.diff(self.neighbour_offsets))
+        longest = np.zeros(len(self.labels), dtype=int)
+        np.maximum.at(longest, rows, self.interfaces)
+
+        candidates = np.nonzero(self.interfaces == longest[rows])[0]
+        found, ix = np.unique(rows[candidates], return_index=True)
+        best[found] = self.neighbours[candidates[ix]]
+        interface[found] = self.interfaces[candidates[ix]]
+
+        return best, interface
+
+    def attach(self, cell):
+        """Copies the stats of a cell that was pickled or copied (e.g. by the
+        processing workers) back to its row, so the cell is again backed by
+        the table"""
+        row = self.row(cell.label)
+        if row is not None and cell.stats.record.base is not self.stats:
+            self.stats[row] = cell.stats.record
+            cell.stats = CellStats(self.stats[row])
+
+
 class Cell(object):
     """Template for each cell object."""
 
+    __slots__ = ("label", "merged_with", "merged_list", "marked_as_noise",
+                 "box", "box_margin", "lines", "outline", "neighbours",
+                 "color_i", "long_axis", "short_axis", "_cell_mask",
+                 "_perim_mask", "_sept_mask", "_cyto_mask", "_membsept_mask",
+                 "_earlysept_mask", "_fullsept_mask", "fluor", "optional",
+                 "base_box", "optional_box", "image", "stats",
+                 "selection_state", "aligned_cell_mask", "aligned_fluor_mask",
+                 "version")
+
+    cell_mask = CompactMask("cell_mask")
+    perim_mask = CompactMask("perim_mask")
+    sept_mask = CompactMask("sept_mask", drawn=True)
+    cyto_mask = CompactMask("cyto_mask")
+    membsept_mask = CompactMask("membsept_mask")
+    earlysept_mask = CompactMask("earlysept_mask")
+    fullsept_mask = CompactMask("fullsept_mask")
+
     def __init__(self, cell_id):
+        self.touch()
         self.label = cell_id
         self.merged_with = "No"
         self.merged_list = []
         self.marked_as_noise = "No"
         self.box = None
         self.box_margin = 5
-        self.lines = []
-        self.outline = []
+        self.lines = np.zeros((0, 3), dtype=np.int32)
+        self.outline = np.zeros((0, 2), dtype=np.int32)
         self.neighbours = {}
         self.color_i = -1
         self.long_axis = []
@@ -44,45 +352,57 @@ class Cell(object):
 
         self.fluor = None
         self.optional = None
+        self.base_box = None
+        self.optional_box = None
         self.image = None
+        self.aligned_cell_mask = None
+        self.aligned_fluor_mask = None
 
-        self.stats = OrderedDict([("Area", 0),
-                                  ("Perimeter", 0),
-                                  ("Length", 0),
-                                  ("Width", 0),
-                                  ("Eccentricity", 0),
-                                  ("Irregularity", 0),
-                                  ("Neighbours", 0),
-                                  ("Baseline", 0),
-                                  ("Cell Median", 0),
-                                  ("Membrane Median", 0),
-                                  ("Septum Median", 0),
-                                  ("Cytoplasm Median", 0),
-                                  ("Full Septum Median", 0),
-                                  ("Full Septum Median 75%", 0),
-                                  ("Full Septum Median 25%", 0),
-                                  ("Full Septum Median 10%", 0),
-                                  ("Early Sept Median", 0),
-                                  ("Fluor Ratio", 0),
-                                  ("Fluor Ratio 75%", 0),
-                                  ("Fluor Ratio 25%", 0),
-                                  ("Fluor Ratio 10%", 0),
-                                  ("Memb+Sept Median", 0),
-                                  ("Cell Cycle Phase", 0)])
+        self.stats = CellStats()
 
         self.selection_state = 1
 
+    def snapshot(self):
+        """Returns a new cell with the region, outline, box, axes, neighbours
+        and morphological stats of this one and every other attribute as on
+        a new cell, i.e. the cell as computed from the labels.
+        The lines, outline and axes arrays are shared, as they are replaced
+        and never changed in place"""
+
+        cell = Cell(self.label)
+        cell.merged_with = self.merged_with
+        cell.merged_list = list(self.merged_list)
+        cell.box = self.box
+        cell.lines = self.lines
+        cell.outline = self.outline
+        cell.neighbours = dict(self.neighbours)
+        cell.long_axis = self.long_axis
+        cell.short_axis = self.short_axis
+
+        for key in ("Area", "Perimeter", "Length", "Width", "Eccentricity",
+                    "Irregularity", "Neighbours"):
+            cell.stats[key] = self.stats[key]
+
+        return cell
+
+    def touch(self):
+        """Gives the cell a new version number. Called whenever the lines,
+        outline or septum of the cell change, so that overlay_cells repaints
+        it. Unlike object ids, version numbers are never reused"""
+        self.version = next(cell_versions)
+
     def clean_cell(self):
         """Resets the cell to an empty instance.
         Can be used to mark the cell to discard"""
+        self.touch()
         self.label = 0
         self.merged_with = "No"
         self.merged_list = []
         self.marked_as_noise = "No"
         self.box = None
         self.box_margin = 5
-        self.lines = []
-        self.outline = []
+        self.lines = np.zeros((0, 3), dtype=np.int32)
+        self.outline = np.zeros((0, 2), dtype=np.int32)
         self.color_i = -1
         self.long_axis = []
         self.short_axis = []
@@ -98,67 +418,10 @@ class Cell(object):
         self.optional = None
         self.image = None
 
-        self.stats = OrderedDict([("Area", 0),
-                                  ("Perimeter", 0),
-                                  ("Length", 0),
-                                  ("Width", 0),
-                                  ("Eccentricity", 0),
-                                  ("Irregularity", 0),
-                                  ("Neighbours", 0),
-                                  ("Baseline", 0),
-                                  ("Cell Median", 0),
-                                  ("Membrane Median", 0),
-                                  ("Septum Median", 0),
-                                  ("Cytoplasm Median", 0),
-                                  ("Full Septum Median", 0),
-                                  ("Full Septum Median 75%", 0),
-                                  ("Full Septum Median 25%", 0),
-                                  ("Full Septum Median 10%", 0),
-                                  ("Early Sept Median", 0),
-                                  ("Fluor Ratio", 0),
-                                  ("Fluor Ratio 75%", 0),
-                                  ("Fluor Ratio 25%", 0),
-                                  ("Fluor Ratio 10%", 0),
-                                  ("Memb+Sept Median", 0),
-                                  ("Cell Cycle Phase", 0)], )
+        self.stats = CellStats()
 
         self.selection_state = 1
 
-    def add_line(self, y, x1, x2, pixel_size):
-        """
-        Adds a line to the cell region and updates area
-        """
-
-        self.lines.append((y, x1, x2))
-        self.stats["Area"] = self.stats["Area"] + (x2 - x1 + 1) * float(pixel_size) * float(pixel_size)
-
-    def add_frontier_point(self, x, y, neighs):
-        """
-        Adds an external point. Neighs is the neighbourhood labels
-        """
-        # check if any neighbour not in labels
-        # nlabels=np.unique(neighs[neighs <> self.label])
-
-        nlabels = []
-        notzero = []
-        for line in neighs:
-            for p in line:
-                if p != self.label and not p in nlabels:
-                    nlabels.append(p)
-                    if p > 0:
-                        notzero.append(p)
-
-        if nlabels != []:
-            self.outline.append((x, y))
-
-        if notzero != []:
-            for l in notzero:
-                if l in self.neighbours.keys():
-                    count = self.neighbours[l]
-                else:
-                    count = 0
-                self.neighbours[l] = count + 1
-
     def compute_box(self, maskshape):
         """ computes the box
         """
@@ -166,10 +429,10 @@ class Cell(object):
         points = np.asarray(self.outline)  # in two columns, x, y
         bm = self.box_margin
         w, h = maskshape
-        self.box = (max(min(points[:, 0]) - bm, 0),
-                    max(min(points[:, 1]) - bm, 0),
-                    min(max(points[:, 0]) + bm, w - 1),
-                    min(max(points[:, 1]) + bm, h - 1))
+        self.box = (int(max(min(points[:, 0]) - bm, 0)),
+                    int(max(min(points[:, 1]) - bm, 0)),
+                    int(min(max(points[:, 0]) + bm, w - 1)),
+                    int(min(max(points[:, 1]) + bm, h - 1)))
 
     def axes_from_rotation(self, x0, y0, x1, y1, rotation, pixel_size):
         """ sets the cell axes from the box and the rotation
@@ -204,7 +467,47 @@ class Cell(object):
         self.stats["Width"] = \
             np.linalg.norm(self.short_axis[1] - self.short_axis[0]) * float(pixel_size)
 
-    def compute_axes(self, rotations, maskshape, pixel_size):
+    def narrowest_rectangle(self, points, rotations, algorithm):
+        """ returns (x0, y0, x1, y1, rotation) of the narrowest bounding
+        rectangle of the points, in the rotated coordinates.
+        Rotations scans all the rotation matrices one by one, Batched projects
+        the points with all of them at once, Calipers finds the exact
+        narrowest rectangle at any angle from the convex hull of the points
+        and Stepped Calipers keeps the better of the two rotation matrices
+        around that angle. Stepped Calipers is an approximation of
+        Rotations: the narrowest rectangle over the rotation matrices is not
+        always next to the narrowest one at any angle
+        """
+
+        # no need to do more rotations, due to symmetry
+        half = rotations[:int(len(rotations) / 2) + 1]
+
+        if algorithm == "Rotations":
+            x0, y0, x1, y1, rix = cp.narrowest_rotation(points, half)
+            return x0, y0, x1, y1, half[rix]
+
+        elif algorithm == "Batched":
+            x0, y0, x1, y1, rix = cp.batched_rotation(points, half)
+            return x0, y0, x1, y1, half[rix]
+
+        elif algorithm == "Calipers":
+            rotation = cp.rotation_stack([cp.caliper_angle(points)])[0]
+            x0, y0, x1, y1, width = cp.bound_rectangle(np.dot(points, rotation))
+            return x0, y0, x1, y1, rotation
+
+        elif algorithm == "Stepped Calipers":
+            step = np.degrees(np.arctan2(rotations[1][0, 1], rotations[1][0, 0]))
+            ix = cp.caliper_angle(points) / step
+            candidates = [half[min(int(np.floor(ix)), len(half) - 1)],
+                          half[min(int(np.ceil(ix)), len(half) - 1)]]
+            x0, y0, x1, y1, rix = cp.narrowest_rotation(points, candidates)
+            return x0, y0, x1, y1, candidates[rix]
+
+        else:
+            print("Not a valid axes algorithm, using Rotations")
+            return self.narrowest_rectangle(points, rotations, "Rotations")
+
+    def compute_axes(self, rotations, maskshape, pixel_size, algorithm="Rotations"):
         """ scans rotation matrices for the narrowest rectangle
         stores the result in self.long_axis and self.short_axis, each a 2,2 array
         with one point per line (coords axes in columns)
@@ -215,23 +518,10 @@ class Cell(object):
 
         self.compute_box(maskshape)
         points = np.asarray(self.outline)  # in two columns, x, y
-        width = len(points) + 1
-
-        # no need to do more rotations, due to symmetry
-        for rix in range(int(len(rotations) / 2 + 1)):
-            r = rotations[rix]
-            nx0, ny0, nx1, ny1, nwidth = cp.bound_rectangle(
-                np.asarray(np.dot(points, r)))
 
-            if nwidth < width:
-                width = nwidth
-                x0 = nx0
-                x1 = nx1
-                y0 = ny0
-                y1 = ny1
-                angle = rix
+        x0, y0, x1, y1, rotation = self.narrowest_rectangle(points, rotations, algorithm)
 
-        self.axes_from_rotation(x0, y0, x1, y1, rotations[angle], pixel_size)
+        self.axes_from_rotation(x0, y0, x1, y1, rotation, pixel_size)
 
         if self.stats["Length"] < self.stats["Width"]:
             dum = self.stats["Length"]
@@ -255,9 +545,9 @@ class Cell(object):
         except TypeError:
             return None
 
-    def compute_cell_mask(self):
+    def compute_cell_mask(self, dtype=float):
         x0, y0, x1, y1 = self.box
-        mask = np.zeros((x1 - x0 + 1, y1 - y0 + 1))
+        mask = np.zeros((x1 - x0 + 1, y1 - y0 + 1), dtype=dtype)
         for lin in self.lines:
             y, st, en = lin
             mask[st - x0:en - x0 + 1, y - y0] = 1.0
@@ -270,8 +560,12 @@ class Cell(object):
         # create mask
 
         eroded = morphology.binary_erosion(mask, np.ones(
-            (thick * 2 - 1, thick - 1))).astype(float)
-        perim = mask - eroded
+            (thick * 2 - 1, thick - 1)))
+
+        if mask.dtype == bool:
+            return mask & ~eroded
+
+        perim = mask - eroded.astype(float)
 
         return perim
 
@@ -314,7 +608,9 @@ class Cell(object):
         else:
             fluor_box = self.fluor
         perim_mask = self.compute_perim_mask(cell_mask, thick)
-        inner_mask = cell_mask - perim_mask
+        inner_mask = (cell_mask > 0) & ~(perim_mask > 0)
+        if cell_mask.dtype != bool:
+            inner_mask = inner_mask.astype(float)
         inner_fluor = (inner_mask > 0) * fluor_box
 
         threshold = threshold_isodata(inner_fluor[inner_fluor > 0])
@@ -330,6 +626,9 @@ class Cell(object):
                 interest_label_sum = np.sum(
                     img_as_float(label_matrix == l + 1))
 
+        if cell_mask.dtype == bool:
+            return label_matrix == interest_label
+
         return img_as_float(label_matrix == interest_label)
 
     def compute_opensept_isodata(self, mask, thick, septum_base, septum_opt):
@@ -343,7 +642,9 @@ class Cell(object):
         else:
             fluor_box = self.fluor
         perim_mask = self.compute_perim_mask(cell_mask, thick)
-        inner_mask = cell_mask - perim_mask
+        inner_mask = (cell_mask > 0) & ~(perim_mask > 0)
+        if cell_mask.dtype != bool:
+            inner_mask = inner_mask.astype(float)
         inner_fluor = (inner_mask > 0) * fluor_box
 
         threshold = threshold_isodata(inner_fluor[inner_fluor > 0])
@@ -375,9 +676,14 @@ class Cell(object):
                 break
 
         if second_label != 0:
-            return img_as_float((label_matrix == first_label) + (label_matrix == second_label))
+            septum = (label_matrix == first_label) + (label_matrix == second_label)
         else:
-            return img_as_float((label_matrix == first_label))
+            septum = label_matrix == first_label
+
+        if cell_mask.dtype == bool:
+            return septum
+
+        return img_as_float(septum)
 
     def compute_sept_box(self, mask, thick):
         """Method used to create a mask of the septum based on creating a box
@@ -396,48 +702,31 @@ class Cell(object):
         if mask is not None:
             linmask = mask * linmask
 
+            if mask.dtype == bool:
+                linmask = linmask > 0
+
         return linmask
 
     def get_outline_points(self, data):
-        """Method used to obtain the outline pixels of the septum"""
-        outline = []
-        for x in range(0, len(data)):
-            for y in range(0, len(data[x])):
-                if data[x, y] == 1:
-                    if x == 0 and y == 0:
-                        neighs_sum = data[x, y] + data[x + 1, y] + \
-                                     data[x + 1, y + 1] + data[x, y + 1]
-                    elif x == len(data) - 1 and y == len(data[x]) - 1:
-                        neighs_sum = data[x, y] + data[x, y - 1] + \
-                                     data[x - 1, y - 1] + data[x - 1, y]
-                    elif x == 0 and y == len(data[x]) - 1:
-                        neighs_sum = data[x, y] + data[x, y - 1] + \
-                                     data[x + 1, y - 1] + data[x + 1, y]
-                    elif x == len(data) - 1 and y == 0:
-                        neighs_sum = data[x, y] + data[x - 1, y] + \
-                                     data[x - 1, y + 1] + data[x, y + 1]
-                    elif x == 0:
-                        neighs_sum = data[x, y] + data[x, y - 1] + data[x, y + 1] + \
-                                     data[x + 1, y - 1] + \
-                                     data[x + 1, y] + data[x + 1, y + 1]
-                    elif x == len(data) - 1:
-                        neighs_sum = data[x, y] + data[x, y - 1] + data[x, y + 1] + \
-                                     data[x - 1, y - 1] + \
-                                     data[x - 1, y] + data[x - 1, y + 1]
-                    elif y == 0:
-                        neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + \
-                                     data[x - 1, y + 1] + \
-                                     data[x, y + 1] + data[x + 1, y + 1]
-                    elif y == len(data[x]) - 1:
-                        neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + \
-                                     data[x - 1, y - 1] + \
-                                     data[x, y - 1] + data[x + 1, y - 1]
-                    else:
-                        neighs_sum = data[x, y] + data[x - 1, y] + data[x + 1, y] + data[x - 1, y - 1] + data[
-                            x, y - 1] + data[x + 1, y - 1] + data[x - 1, y + 1] + data[x, y + 1] + data[x + 1, y + 1]
-                    if neighs_sum != 9:
-                        outline.append((x, y))
-        return outline
+        """Method used to obtain the outline pixels of the septum.
+        A pixel of the septum is part of the outline if any pixel of its 3x3
+        neighbourhood, clipped to the mask, is not part of the septum.
+        Returns the points ordered by line and then column"""
+        data = np.asarray(data)
+        inside = data == 1
+
+        # sum of each 3x3 neighbourhood, pixels outside the mask count as 0
+        padded = np.zeros((data.shape[0] + 2, data.shape[1] + 2))
+        padded[1:-1, 1:-1] = data
+        h, w = data.shape
+        neighs_sum = np.zeros(data.shape)
+        for dx in range(3):
+            for dy in range(3):
+                neighs_sum += padded[dx:dx + h, dy:dy + w]
+
+        xs, ys = np.nonzero(inside & (neighs_sum != 9))
+
+        return list(zip(xs.tolist(), ys.tolist()))
 
     def compute_sept_box_fix(self, outline, maskshape):
         """Method used to create a box aroung the septum, so that the short
@@ -453,7 +742,7 @@ class Cell(object):
 
         return box
 
-    def remove_sept_from_membrane(self, maskshape):
+    def remove_sept_from_membrane(self, maskshape, algorithm="Rotations"):
         """Method used to remove the pixels of the septum that were still in
         the membrane"""
 
@@ -468,23 +757,8 @@ class Cell(object):
         # compute axis of the septum
         rotations = cp.rotation_matrices(5)
         points = np.asarray(septum_outline)  # in two columns, x, y
-        width = len(points) + 1
-
-        # no need to do more rotations, due to symmetry
-        for rix in range(int(len(rotations) / 2) + 1):
-            r = rotations[rix]
-            nx0, ny0, nx1, ny1, nwidth = cp.bound_rectangle(
-                np.asarray(np.dot(points, r)))
 
-            if nwidth < width:
-                width = nwidth
-                x0 = nx0
-                x1 = nx1
-                y0 = ny0
-                y1 = ny1
-                angle = rix
-
-        rotation = rotations[angle]
+        x0, y0, x1, y1, rotation = self.narrowest_rectangle(points, rotations, algorithm)
 
         # midpoints
         mx = (x1 + x0) / 2
@@ -640,7 +914,12 @@ class Cell(object):
         self.fluor = self.fluor_box(image_manager.fluor_image)
         self.optional = self.fluor_box(image_manager.optional_image)
 
-        self.cell_mask = self.compute_cell_mask()
+        # masks are stored as bool when the global mask is bool (Single
+        # precision) and as float 0/1 arrays otherwise
+        if image_manager.mask.dtype == bool:
+            self.cell_mask = self.compute_cell_mask(bool)
+        else:
+            self.cell_mask = self.compute_cell_mask()
 
         if params.find_septum:
             self.recursive_compute_sept(self.cell_mask,
@@ -655,21 +934,21 @@ class Cell(object):
 
                 self.membsept_mask = (self.perim_mask + self.sept_mask) > 0
                 linmask = self.remove_sept_from_membrane(
-                    image_manager.mask.shape)
-                self.cyto_mask = (self.cell_mask - self.perim_mask -
-                                  self.sept_mask) > 0
+                    image_manager.mask.shape, params.axes_algorithm)
+                self.cyto_mask = (self.cell_mask > 0) & ~(self.perim_mask > 0) & \
+                    ~(self.sept_mask > 0)
                 if linmask is not None:
                     self.earlysept_mask = (self.perim_mask.astype(np.int))&(linmask.astype(np.int))
                     self.fullsept_mask = (self.sept_mask.astype(np.int))+(self.earlysept_mask.astype(np.int))
                     old_membrane = self.perim_mask
-                    self.perim_mask = (old_membrane - linmask) > 0
+                    self.perim_mask = (old_membrane > 0) & ~(linmask > 0)
             else:
                 self.perim_mask = (self.compute_perim_mask(self.cell_mask,
-                                                           params.inner_mask_thickness) -
-                                   self.sept_mask) > 0
+                                                           params.inner_mask_thickness) > 0) & \
+                    ~(self.sept_mask > 0)
                 self.membsept_mask = (self.perim_mask + self.sept_mask) > 0
-                self.cyto_mask = (self.cell_mask - self.perim_mask -
-                                  self.sept_mask) > 0
+                self.cyto_mask = (self.cell_mask > 0) & ~(self.perim_mask > 0) & \
+                    ~(self.sept_mask > 0)
         elif params.find_openseptum:
             self.recursive_compute_opensept(self.cell_mask,
                                             params.inner_mask_thickness,
@@ -683,30 +962,33 @@ class Cell(object):
 
                 self.membsept_mask = (self.perim_mask + self.sept_mask) > 0
                 linmask = self.remove_sept_from_membrane(
-                    image_manager.mask.shape)
-                self.cyto_mask = (self.cell_mask - self.perim_mask -
-                                  self.sept_mask) > 0
+                    image_manager.mask.shape, params.axes_algorithm)
+                self.cyto_mask = (self.cell_mask > 0) & ~(self.perim_mask > 0) & \
+                    ~(self.sept_mask > 0)
                 if linmask is not None:
                     self.earlysept_mask = (self.perim_mask.astype(np.int))&(linmask.astype(np.int))
                     self.fullsept_mask = (self.sept_mask.astype(np.int))+(self.earlysept_mask.astype(np.int))
                     old_membrane = self.perim_mask
-                    self.perim_mask = (old_membrane - linmask) > 0
+                    self.perim_mask = (old_membrane > 0) & ~(linmask > 0)
             else:
                 self.perim_mask = (self.compute_perim_mask(self.cell_mask,
-                                                           params.inner_mask_thickness) -
-                                   self.sept_mask) > 0
+                                                           params.inner_mask_thickness) > 0) & \
+                    ~(self.sept_mask > 0)
                 self.membsept_mask = (self.perim_mask + self.sept_mask) > 0
-                self.cyto_mask = (self.cell_mask - self.perim_mask -
-                                  self.sept_mask) > 0
+                self.cyto_mask = (self.cell_mask > 0) & ~(self.perim_mask > 0) & \
+                    ~(self.sept_mask > 0)
         else:
             self.sept_mask = None
             self.perim_mask = self.compute_perim_mask(self.cell_mask,
                                                       params.inner_mask_thickness)
-            self.cyto_mask = (self.cell_mask - self.perim_mask) > 0
+            self.cyto_mask = (self.cell_mask > 0) & ~(self.perim_mask > 0)
 
-    def compute_fluor_baseline(self, mask, fluor, margin):
+    def compute_fluor_baseline(self, mask, fluor, margin, background=None):
         """mask and fluor are the global images
            NOTE: mask is 0 (black) at cells and 1 (white) outside
+           background is the global mask from cp.background_mask. When
+           given, the window around the cell is taken from it instead of
+           dilating the cells inside the window
         """
 
         x0, y0, x1, y1 = self.box
@@ -715,6 +997,13 @@ class Cell(object):
         y0 = max(y0 - margin, 0)
         x1 = min(x1 + margin, wid - 1)
         y1 = min(y1 + margin, hei - 1)
+
+        if background is not None:
+            mask_box = background[x0:x1, y0:y1]
+            fluor_box = fluor[x0:x1, y0:y1]
+            self.stats["Baseline"] = np.median(fluor_box[mask_box])
+            return
+
         mask_box = mask[x0:x1, y0:y1]
 
         count = 0
@@ -755,11 +1044,11 @@ class Cell(object):
         else:
             return 0
 
-    def compute_fluor_stats(self, params, image_manager):
+    def compute_fluor_stats(self, params, image_manager, background=None):
         """Computes the cell stats related to the fluorescence"""
         self.compute_fluor_baseline(image_manager.mask,
                                     image_manager.original_fluor_image,
-                                    params.baseline_margin)
+                                    params.baseline_margin, background)
 
         fluorbox = self.fluor_box(image_manager.original_fluor_image)
 
@@ -877,25 +1166,19 @@ class Cell(object):
         return img
 
     def recompute_outline(self, labels):
-        ids = self.merged_list
-        ids.append(self.label)
-        new_outline = []
+        """Returns the points of the outline that touch a pixel outside the
+        cell and the cells merged with it, i.e. the outline without the
+        interfaces between merged cells. The 3x3 neighbourhoods of all the
+        points are taken from the labels at once"""
 
-        for px in self.outline:
-            y, x = px
-            neigh_pixels = labels[y - 1:y + 2, x - 1:x + 2].flatten()
+        points = np.asarray(self.outline)
+        ids = np.array(self.merged_list + [self.label])
 
-            outline_check = False
+        rows = points[:, 0, None] + np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+        cols = points[:, 1, None] + np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+        inside = np.all(np.isin(labels[rows, cols], ids), axis=1)
 
-            for val in neigh_pixels:
-                if val in ids:
-                    pass
-                else:
-                    outline_check = True
-            if outline_check:
-                new_outline.append(px)
-
-        self.outline = new_outline
+        return np.reshape(np.array(points[~inside], dtype=np.int32), (-1, 2))
 
 
 class CellManager(object):
@@ -904,7 +1187,10 @@ class CellManager(object):
 
     def __init__(self, params):
         self.cells = {}
+        self.table = None
         self.original_cells = {}
+        self.merge_parents = {}
+        self.pending_merges = {}
         self.merged_cells = []
         self.merged_labels = None
 
@@ -916,6 +1202,11 @@ class CellManager(object):
         self.fluor_w_cells = None
         self.optional_w_cells = None
 
+        # kept to repaint only the cells that changed in overlay_cells
+        self.overlay_sources = None
+        self.overlay_grays = {}
+        self.overlay_states = {}
+
     def clean_empty_cells(self):
         """Removes empty cell objects from the cells dict"""
         newcells = {}
@@ -932,43 +1223,41 @@ class CellManager(object):
         elements for all different labels. Each cell is at index label-1
         """
 
-        difLabels = []
-        for line in labels:
-            difLabels.extend(set(line))
-        difLabels = sorted(set(difLabels))[1:]
+        difLabels = np.unique(labels)[1:]
 
-        cells = {}
+        lines = cp.label_lines(labels)
+        outline, contacts = cp.label_frontiers(labels)
 
-        for f in difLabels:
-            cells[str(int(f))] = Cell(f)
+        # lines and outline points are grouped by label, keeping scan order
+        lines = lines[np.isin(lines[:, 0], difLabels)]
+        line_ix = np.searchsorted(difLabels, lines[:, 0])
+        order = np.argsort(line_ix, kind="stable")
+        line_offsets = np.searchsorted(line_ix[order], np.arange(len(difLabels) + 1))
 
-        for y in range(1, len(labels[0, :]) - 1):
-            old_label = 0
-            x1 = -1
-            x2 = -1
+        outline = outline[np.isin(outline[:, 0], difLabels)]
+        point_ix = np.searchsorted(difLabels, outline[:, 0])
+        point_order = np.argsort(point_ix, kind="stable")
+        outline_offsets = np.searchsorted(point_ix[point_order],
+                                          np.arange(len(difLabels) + 1))
 
-            for x in range(1, len(labels[:, 0]) - 1):
-                l = int(labels[x, y])
+        table = CellTable(difLabels,
+                          lines[order, 1:].astype(np.int32), line_offsets,
+                          outline[point_order, 1:].astype(np.int32), outline_offsets)
 
-                # check if line began or ended, add line
-                if l != old_label:
-                    if x1 > 0:
-                        x2 = x - 1
-                        cells[str(old_label)].add_line(y, x1, x2, pixel_size)
-                        x1 = -1
-                    if l > 0:
-                        x1 = x
-                    old_label = l
+        area = table.stats["Area"]
+        np.add.at(area, line_ix,
+                  (lines[:, 3] - lines[:, 2] + 1) * float(pixel_size) * float(pixel_size))
+        table.stats["Perimeter"] = np.diff(outline_offsets) * float(pixel_size)
 
-                # check neighbours
-                if l > 0:
-                    square = labels[x - 1:x + 2, y - 1:y + 2]
-                    cells[str(l)].add_frontier_point(x, y, square)
+        table.set_neighbours(contacts)
+        table.stats["Neighbours"] = np.diff(table.neighbour_offsets)
 
-        for key in cells.keys():
-            cells[key].stats["Perimeter"] = len(cells[key].outline) * float(pixel_size)
-            cells[key].stats["Neighbours"] = len(cells[key].neighbours)
+        cells = {}
+        for ix, f in enumerate(difLabels):
+            cells[str(int(f))] = table.cell(ix)
+            cells[str(int(f))].neighbours = table.neighbour_dict(ix)
 
+        self.table = table
         self.cells = cells
 
     def overlay_cells_w_base(self, base_image):
@@ -978,6 +1267,7 @@ class CellManager(object):
 
         base = color.rgb2gray(img_as_float(base_image))
         base = exposure.rescale_intensity(base)
+        self.overlay_grays["base"] = base
 
         self.base_w_cells = cp.overlay_cells(self.cells, base,
                                              self.cell_colors)
@@ -986,6 +1276,7 @@ class CellManager(object):
         """Creates na overlay of the cells over the fluor image)"""
         fluor = color.rgb2gray(img_as_float(fluor_image))
         fluor = exposure.rescale_intensity(fluor)
+        self.overlay_grays["fluor"] = fluor
         self.fluor_w_cells = cp.overlay_cells(self.cells, fluor,
                                               self.cell_colors)
 
@@ -993,28 +1284,101 @@ class CellManager(object):
         """Creates an overlay of the cells over the optional image"""
         optional = color.rgb2gray(img_as_float(optional_image))
         optional = exposure.rescale_intensity(optional)
+        self.overlay_grays["optional"] = optional
         self.optional_w_cells = cp.overlay_cells(self.cells, optional, self.cell_colors)
 
     def overlay_cells(self, image_manager):
         """Calls the methods used to create an overlay of the cells
-        over the base and fluor images"""
-        labels = np.zeros(image_manager.fluor_image.shape)
+        over the base and fluor images.
+        The label map and the overlays are kept between calls and, when only
+        a few cells changed since the last call, only the regions of those
+        cells are repainted"""
 
-        for k in self.cells.keys():
-            c = self.cells[k]
-            labels = cp.paint_cell(c, labels, c.label)
+        sources = (image_manager.base_image, image_manager.fluor_image,
+                   image_manager.optional_image)
+
+        changed = [k for k in self.cells.keys()
+                   if k not in self.overlay_states or
+                   self.overlay_states[k][0] != cp.cell_state(self.cells[k])]
+        removed = [k for k in self.overlay_states.keys()
+                   if k not in self.cells]
+
+        same_sources = self.overlay_sources is not None and \
+            all(a is b for a, b in zip(sources, self.overlay_sources))
+
+        if same_sources and 4 * (len(changed) + len(removed)) <= len(self.cells):
+            self.repaint_cells(changed, removed)
+
+        else:
+            labels = np.zeros(image_manager.fluor_image.shape)
 
-        self.merged_labels = labels
-        self.overlay_cells_w_base(image_manager.base_image)
-        self.overlay_cells_w_fluor(image_manager.fluor_image)
+            for k in self.cells.keys():
+                c = self.cells[k]
+                labels = cp.paint_cell(c, labels, c.label)
+
+            self.merged_labels = labels
+            self.overlay_cells_w_base(image_manager.base_image)
+            self.overlay_cells_w_fluor(image_manager.fluor_image)
+
+            if image_manager.optional_image is not None:
+                self.overlay_cells_w_optional(image_manager.optional_image)
 
-        if image_manager.optional_image is not None:
-            self.overlay_cells_w_optional(image_manager.optional_image)
+            self.overlay_states = {}
+            changed = list(self.cells.keys())
 
-    def compute_box_axes(self, rotations, maskshape, pixel_size):
+        # drawing can reject cells, so the states are only stored afterwards
+        self.overlay_sources = sources
+        for k in changed:
+            c = self.cells[k]
+            self.overlay_states[k] = (cp.cell_state(c), cp.cell_extent(c))
+
+    def repaint_cells(self, changed, removed):
+        """Repaints the label map and the overlays over the old and new
+        regions of the changed and removed cells"""
+
+        regions = []
+        for k in changed + removed:
+            if k in self.overlay_states:
+                regions.append(self.overlay_states[k][1])
+        for k in changed:
+            regions.append(cp.cell_extent(self.cells[k]))
+            # placeholder until the cell is drawn, for the intersections
+            self.overlay_states[k] = (None, regions[-1])
+        for k in removed:
+            del self.overlay_states[k]
+
+        keys = list(self.cells.keys())
+        extents = np.array([self.overlay_states[k][1] or (-1, -1, -2, -2)
+                            for k in keys]).reshape(-1, 4)
+
+        overlays = [(self.base_w_cells, "base"),
+                    (self.fluor_w_cells, "fluor"),
+                    (self.optional_w_cells, "optional")]
+
+        for region in regions:
+            if region is None:
+                continue
+
+            x0, y0, x1, y1 = region
+            inside = (extents[:, 0] <= x1) & (extents[:, 2] >= x0) & \
+                     (extents[:, 1] <= y1) & (extents[:, 3] >= y0)
+            region_keys = [keys[ix] for ix in np.flatnonzero(inside)]
+
+            self.merged_labels[x0:x1 + 1, y0:y1 + 1] = 0
+            cp.paint_cells_region(self.cells, region_keys,
+                                  self.merged_labels, region)
+
+            for overlay, name in overlays:
+                if overlay is not None and name in self.overlay_grays:
+                    overlay[x0:x1 + 1, y0:y1 + 1] = color.gray2rgb(
+                        self.overlay_grays[name][x0:x1 + 1, y0:y1 + 1])
+                    cp.draw_cells(self.cells, region_keys, overlay,
+                                  self.cell_colors, region)
+
+    def compute_box_axes(self, rotations, maskshape, pixel_size, algorithm="Rotations"):
         for k in self.cells.keys():
             if self.cells[k].stats["Area"] > 0:
-                self.cells[k].compute_axes(rotations, maskshape, pixel_size)
+                self.cells[k].compute_axes(rotations, maskshape, pixel_size, algorithm)
 
     def compute_cells(self, params, image_manager, segments_manager):
         """Creates a cell list that is stored on self.cells as a dict, where
@@ -1027,78 +1391,214 @@ class CellManager(object):
         self.cell_regions_from_labels(segments_manager.labels, params.imageloaderparams.pixel_size)
         rotations = cp.rotation_matrices(params.cellprocessingparams.axial_step)
 
-        self.compute_box_axes(rotations, image_manager.mask.shape, params.imageloaderparams.pixel_size)
-
-        self.original_cells = deepcopy(self.cells)
+        self.compute_box_axes(rotations, image_manager.mask.shape, params.imageloaderparams.pixel_size,
+                              params.cellprocessingparams.axes_algorithm)
 
-        for k in list(self.cells.keys()):
-            try:
-                c = self.cells[k]
-                if len(c.neighbours) > 0:
+        self.original_cells = {}
+        self.merge_parents = {}
+        self.pending_merges = {}
+
+        # each cell is checked against its best neighbour on the labels. The
+        # areas only grow with merges, so the cells left out here could not
+        # pass check_merge later
+        best, interfaces = self.table.best_neighbours()
+        areas = self.table.stats["Area"]
+        neighbour_areas = areas[np.minimum(np.searchsorted(self.table.labels, best),
+                                           len(areas) - 1)]
+        candidates = cp.merge_candidates(areas, neighbour_areas, interfaces, params)
+
+        for row in np.nonzero(candidates)[0]:
+            c = self.cells.get(str(int(self.table.labels[row])))
+            cn = self.cells.get(str(int(best[row])))
+            if c is None or cn is None:
+                print("Cell was already merged and deleted")
+                continue
 
-                    bestneigh = max(list(iter(c.neighbours.keys())),
-                                    key=(lambda key: c.neighbours[key]))
-                    bestinterface = c.neighbours[bestneigh]
-                    cn = self.cells[str(int(bestneigh))]
+            self.update_merged_axes(c.label, rotations, params, image_manager)
+            self.update_merged_axes(cn.label, rotations, params, image_manager)
+            if cp.check_merge(c, cn, rotations, interfaces[row],
+                              image_manager.mask, params):
+                self.join_cells(c.label, cn.label, segments_manager.labels)
 
-                    if cp.check_merge(c, cn, rotations, bestinterface,
-                                      image_manager.mask, params):
-                        self.merge_cells(c.label, cn.label, params, segments_manager, image_manager)
-            except KeyError:
-                print("Cell was already merged and deleted")
+        self.finish_merges(params, segments_manager, image_manager)
 
-        for k in self.cells.keys():
-            cp.assign_cell_color(self.cells[k], self.cells,
-                                 self.cell_colors, params.imageloaderparams.pixel_size)
+        self.assign_colors(params)
         self.overlay_cells(image_manager)
 
-    def merge_cells(self, label_c1, label_c2, params, segments_manager, image_manager):
-        """merges two cells"""
+    def record_original(self, label):
+        """Keeps a snapshot of the cell as computed from the labels the first
+        time it is changed by a merge or a split, so that split_cells can
+        restore it. Only the cells that were touched are recorded"""
+        key = str(int(label))
+        if key not in self.original_cells:
+            self.original_cells[key] = self.cells[key].snapshot()
+
+    def find_cell(self, label):
+        """Returns the label of the cell that holds the region of the label,
+        following the merges made since compute_cells"""
+        label = int(label)
+        parents = self.merge_parents
+        while label in parents:
+            parent = parents[label]
+            if parent in parents:
+                parents[label] = parents[parent]
+            label = parent
+
+        return label
+
+    def join_cells(self, label_c1, label_c2, labels):
+        """Merges the cell label_c1 into the cell label_c2, adding up their
+        area, lines and outlines. The axes and the outline of the merged cell
+        are only recomputed by finish_merges, but a cell that was already
+        merged has its outline pruned here, so that the outline (and the
+        Irregularity) of a chain of merges is the same as merging one pair
+        at a time"""
         label_c1 = int(label_c1)
         label_c2 = int(label_c2)
-        self.cells[str(label_c2)].stats["Area"] = self.cells[str(label_c2)].stats[
-                                                      "Area"] + self.cells[str(label_c1)].stats["Area"]
-
-        self.cells[str(label_c2)].lines.extend(self.cells[str(label_c1)].lines)
-
-        self.cells[str(label_c2)].merged_list.append(label_c1)
-
-        self.cells[str(label_c2)].outline.extend(self.cells[str(label_c1)].outline)
-        self.cells[str(label_c2)].stats["Neighbours"] = self.cells[str(label_c2)].stats["Neighbours"] + \
-                                                        self.cells[str(label_c1)].stats["Neighbours"] - 2
-
-        del self.cells[str(label_c1)]
-
+        self.record_original(label_c1)
+        self.record_original(label_c2)
+        c1 = self.cells.pop(str(label_c1))
+        c2 = self.cells[str(label_c2)]
+
+        for cell in (c1, c2):
+            if cell.label in self.pending_merges:
+                cell.outline = cell.recompute_outline(labels)
+
+        c2.stats["Area"] = c2.stats["Area"] + c1.stats["Area"]
+        c2.stats["Neighbours"] = c2.stats["Neighbours"] + c1.stats["Neighbours"] - 2
+        c2.lines = np.concatenate((c2.lines, c1.lines))
+        c2.outline = np.concatenate((c2.outline, c1.outline))
+        c2.touch()
+
+        for label in [label_c1] + c1.merged_list:
+            if label != label_c2 and label not in c2.merged_list:
+                c2.merged_list.append(label)
+
+        self.merge_parents[label_c1] = label_c2
+        self.pending_merges.pop(label_c1, None)
+        self.pending_merges[label_c2] = False
+
+    def update_merged_axes(self, label, rotations, params, image_manager):
+        """Recomputes the axes of a cell with pending merges, for the merge
+        checks that need its width. The outline points between the merged
+        cells do not change the narrowest rectangle"""
+        label = int(label)
+        if self.pending_merges.get(label) is False:
+            self.cells[str(label)].compute_axes(rotations, image_manager.mask.shape,
+                                                params.imageloaderparams.pixel_size,
+                                                params.cellprocessingparams.axes_algorithm)
+            self.pending_merges[label] = True
+
+    def finish_merges(self, params, segments_manager, image_manager):
+        """Recomputes the axes, outline and perimeter of the cells merged by
+        join_cells, once per merged cell"""
         rotations = cp.rotation_matrices(params.cellprocessingparams.axial_step)
-        self.cells[str(label_c2)].compute_axes(rotations, image_manager.mask.shape, params.imageloaderparams.pixel_size)
 
-        self.cells[str(label_c2)].recompute_outline(segments_manager.labels)
-        self.cells[str(label_c2)].stats["Perimeter"] = len(self.cells[str(label_c2)].outline) * float(
-            params.imageloaderparams.pixel_size)
+        for label, axes_done in self.pending_merges.items():
+            cell = self.cells[str(label)]
+            if not axes_done:
+                cell.compute_axes(rotations, image_manager.mask.shape,
+                                  params.imageloaderparams.pixel_size,
+                                  params.cellprocessingparams.axes_algorithm)
+            cell.outline = cell.recompute_outline(segments_manager.labels)
+            cell.touch()
+            cell.stats["Perimeter"] = len(cell.outline) * float(
+                params.imageloaderparams.pixel_size)
+            cell.merged_with = "Yes"
+
+        self.pending_merges = {}
+
+    def neighbour_graph(self):
+        """Returns the adjacency matrix (CSR) of the cells, over the rows of
+        the table. The adjacency of the labels is followed through the
+        merges, so a merged cell neighbours every cell that touches one of
+        its parts"""
+        table = self.table
+        n = len(table.labels)
+
+        holder = np.arange(n)
+        for label in self.merge_parents.keys():
+            holder[table.row(label)] = table.row(self.find_cell(label))
+
+        rows = holder[np.repeat(np.arange(n), np.diff(table.neighbour_offsets))]
+        neighbours = holder[np.searchsorted(table.labels, table.neighbours)]
+        keep = rows != neighbours
+
+        return csr_matrix((np.ones(np.count_nonzero(keep), dtype=bool),
+                           (rows[keep], neighbours[keep])), shape=(n, n))
+
+    def assign_colors(self, params, labels=None):
+        """Assigns to the cells a colour index that differs from the ones of
+        their neighbours, while there are colours left. All the cells are
+        coloured, in order, or only the cells of the labels (e.g. the cells
+        changed by a merge or a split), keeping the colours of the others.
+        A cell of the labels also keeps its colour if no neighbour has it"""
+        table = self.table
+        graph = self.neighbour_graph()
+        colors = np.full(len(table.labels), -1)
+
+        if labels is None:
+            keys = list(self.cells.keys())
+        else:
+            others = list(self.cells.keys())
+            colors[np.searchsorted(table.labels, [int(k) for k in others])] = \
+                [self.cells[k].color_i for k in others]
+            clashes = cp.color_clashes(graph, colors)
+            keys = [str(int(l)) for l in labels if str(int(l)) in self.cells and
+                    clashes[table.row(l)]]
+
+        rows = np.searchsorted(table.labels, [int(k) for k in keys]).astype(int)
+        colors[rows] = -1
+
+        preferred = cp.preferred_colors(table.stats["Area"],
+                                        params.imageloaderparams.pixel_size,
+                                        len(self.cell_colors))
+        cp.greedy_colors(graph, rows.tolist(), preferred, colors,
+                         len(self.cell_colors))
+
+        for k, row in zip(keys, rows.tolist()):
+            self.cells[k].color_i = int(colors[row])
+
+    def merge_pairs(self, pairs, params, segments_manager, image_manager):
+        """Merges each (label_c1, label_c2) pair of cells in order. The labels
+        of cells that were already merged refer to the cell holding them"""
+        for label_c1, label_c2 in pairs:
+            label_c1 = self.find_cell(label_c1)
+            label_c2 = self.find_cell(label_c2)
+            if label_c1 != label_c2:
+                self.join_cells(label_c1, label_c2, segments_manager.labels)
+
+        merged = list(self.pending_merges.keys())
+        self.finish_merges(params, segments_manager, image_manager)
+        self.assign_colors(params, merged)
 
-        if len(self.cells[str(label_c2)].merged_list) > 0:
-            self.cells[str(label_c2)].merged_with = "Yes"
+    def merge_cells(self, label_c1, label_c2, params, segments_manager, image_manager):
+        """merges two cells"""
+        self.merge_pairs([(label_c1, label_c2)], params, segments_manager, image_manager)
 
     def split_cells(self, label_c1, params, segments_manager, image_manager):
         """Splits a previously merged cell."""
-        merged_cells = self.cells[str(label_c1)].merged_list
-        merged_cells.append(label_c1)
+        self.record_original(label_c1)
+        merged_cells = self.cells[str(label_c1)].merged_list + [label_c1]
         del self.cells[str(label_c1)]
 
         rotations = cp.rotation_matrices(params.cellprocessingparams.axial_step)
         for id in merged_cells:
             id = int(id)
-            self.cells[str(id)] = deepcopy(self.original_cells[str(id)])
-            self.cells[str(id)].compute_axes(rotations, image_manager.mask.shape, params.imageloaderparams.pixel_size)
-            self.cells[str(id)].recompute_outline(segments_manager.labels)
+            self.merge_parents.pop(id, None)
+            self.cells[str(id)] = self.original_cells[str(id)].snapshot()
+            self.table.attach(self.cells[str(id)])
+            self.cells[str(id)].compute_axes(rotations, image_manager.mask.shape, params.imageloaderparams.pixel_size,
+                                             params.cellprocessingparams.axes_algorithm)
+            self.cells[str(id)].outline = \
+                self.cells[str(id)].recompute_outline(segments_manager.labels)
+            self.cells[str(id)].touch()
             self.cells[str(id)].stats["Perimeter"] = len(self.cells[str(id)].outline) * float(
                 params.imageloaderparams.pixel_size)
         if len(self.cells[str(id)].merged_list) == 0:
             self.cells[str(id)].merged_with = "No"
 
-        for k in self.cells.keys():
-            cp.assign_cell_color(self.cells[k], self.cells,
-                                 self.cell_colors, params.imageloaderparams.pixel_size)
+        self.assign_colors(params, merged_cells)
 
     def mark_cell_as_noise(self, label_c1, image_manager, is_noise):
         """Used to change the selection_state of a cell to 0 (noise)
@@ -1116,12 +1616,29 @@ class CellManager(object):
     def process_cells(self, params, image_manager):
         """Method used to compute the individual regions of each cell and the
         computation of the stats related to the fluorescence"""
-        for k in list(self.cells.keys()):
-            try:
-                self.cells[k].compute_regions(params, image_manager)
-                self.cells[k].compute_fluor_stats(params, image_manager)
-            except TypeError:
-                del self.cells[k]
+        background = None
+        if params.baseline_algorithm == "Global":
+            background = cp.background_mask(image_manager.mask)
+
+        if params.processing_workers > 1 and len(self.cells) > 1:
+            self.process_cells_parallel(params, image_manager, background)
+        else:
+            for k in list(self.cells.keys()):
+                try:
+                    self.cells[k].compute_regions(params, image_manager)
+                    if params.fluor_stats_algorithm == "Whole Image":
+                        self.cells[k].compute_fluor_baseline(image_manager.mask,
+                                                             image_manager.original_fluor_image,
+                                                             params.baseline_margin,
+                                                             background)
+                    else:
+                        self.cells[k].compute_fluor_stats(params, image_manager,
+                                                          background)
+                except TypeError:
+                    del self.cells[k]
+
+        if params.fluor_stats_algorithm == "Whole Image":
+            self.compute_fluor_stats(params, image_manager)
 
         fluorgray = exposure.rescale_intensity(color.rgb2gray(img_as_float(
             image_manager.fluor_image)))
@@ -1130,6 +1647,88 @@ class CellManager(object):
 
         self.overlay_cells(image_manager)
 
+    def process_cells_parallel(self, params, image_manager, background=None):
+        """Computes the regions and fluorescence stats of the cells in a pool
+        of params.processing_workers processes.
+        The images are copied once to shared memory instead of being sent
+        to the workers with every cell. The processed cells replace the ones
+        in self.cells and the cells that could not be processed are
+        removed"""
+        keys = list(self.cells.keys())
+        buffers = SharedImages.share(image_manager, background)
+        chunksize = max(1, int(len(keys) / (4 * params.processing_workers)))
+
+        pool = mp.Pool(params.processing_workers, initializer=init_worker,
+                       initargs=(buffers, params))
+        try:
+            results = pool.map(process_cell,
+                               [self.cells[k] for k in keys], chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+        for k, cell in zip(keys, results):
+            if cell is None:
+                del self.cells[k]
+            else:
+                self.table.attach(cell)
+                cell.touch()
+                self.cells[k] = cell
+
+    def compute_fluor_stats(self, params, image_manager):
+        """Computes the stats related to the fluorescence of all the cells at
+        once, from the values of the fluor image inside the regions of every
+        cell. Gives the same stats as Cell.compute_fluor_stats, with each
+        region median computed only once. Needs the regions and the baseline
+        of the cells"""
+
+        keys = list(self.cells.keys())
+        cells = [self.cells[k] for k in keys]
+        fluor = image_manager.original_fluor_image
+
+        regions = ["cell_mask", "perim_mask", "cyto_mask"]
+        if params.find_septum or params.find_openseptum:
+            regions.extend(["sept_mask", "membsept_mask", "earlysept_mask",
+                            "fullsept_mask"])
+
+        medians = {}
+        for name in regions:
+            groups, values, missing = cp.region_values(cells, name, fluor)
+            for fraction in (1.0, 0.75, 0.25, 0.10):
+                if fraction < 1 and name not in ("sept_mask", "fullsept_mask"):
+                    continue
+                result = cp.grouped_medians(groups, values, len(cells), fraction)
+                result[missing] = 0
+                medians[name, fraction] = result
+
+        for ix, c in enumerate(cells):
+            baseline = c.stats["Baseline"]
+            membrane = medians["perim_mask", 1.0][ix] - baseline
+
+            c.stats["Cell Median"] = medians["cell_mask", 1.0][ix] - baseline
+            c.stats["Membrane Median"] = membrane
+            c.stats["Cytoplasm Median"] = medians["cyto_mask", 1.0][ix] - baseline
+
+            if params.find_septum or params.find_openseptum:
+                c.stats["Septum Median"] = medians["sept_mask", 1.0][ix] - baseline
+                c.stats["Fluor Ratio"] = c.stats["Septum Median"] / membrane
+                for fraction, pct in ((0.75, "75%"), (0.25, "25%"), (0.10, "10%")):
+                    c.stats["Fluor Ratio " + pct] = \
+                        (medians["sept_mask", fraction][ix] - baseline) / membrane
+                    c.stats["Full Septum Median " + pct] = \
+                        medians["fullsept_mask", fraction][ix] - baseline
+                c.stats["Memb+Sept Median"] = medians["membsept_mask", 1.0][ix] - baseline
+                c.stats["Early Sept Median"] = medians["earlysept_mask", 1.0][ix] - baseline
+                c.stats["Full Septum Median"] = medians["fullsept_mask", 1.0][ix] - baseline
+
+            else:
+                for stat in ("Septum Median", "Fluor Ratio", "Fluor Ratio 75%",
+                             "Fluor Ratio 25%", "Fluor Ratio 10%",
+                             "Memb+Sept Median", "Early Sept Median",
+                             "Full Septum Median", "Full Septum Median 10%",
+                             "Full Septum Median 25%", "Full Septum Median 75%"):
+                    c.stats[stat] = 0
+
     def filter_cells(self, params, image_manager):
         """Gets the list of filters on the parameters [("Stat", min, max)].
         Compares each cell to the filter and only select the ones that pass the filter"""
@@ -3,15 +3,17 @@ Controls the flow of the analysis and handles the interaction of the different
 modules.
 Contains a single class EHooke."""
 
+import os
+import copy
 from tkinter import filedialog as tkFileDialog
 from parameters import ParametersManager
-from images import ImageManager
+from images import ImageManager, warm_up_stardist, read_frames, prefetch_frames
 from segments import SegmentsManager
 from cells import CellManager
 from reports import ReportManager
 from linescan import LineScanManager
 from colocmanager import ColocManager
-from cellcycleclassifier import CellCycleClassifier
+from cellcycleclassifier import CellCycleClassifier, warm_up_cellcycle_model
 from cellaverager import CellAverager  # todo
 
 
@@ -28,6 +30,7 @@ class EHooke(object):
         self.linescan_manager = None
         self.coloc_manager = None
         self.report_manager = None
+        self.cellcycleclassifier = None
         self.working_dir = None
         self.base_path = None
         self.fluor_path = None
@@ -50,12 +53,92 @@ class EHooke(object):
 
         print("Base Image Loaded")
 
+    def load_hyperstack(self, filename=None):
+        """Calls the load_hyperstack method from the ImageManager, to load
+        the base, fluor and optional images from the channels of a single
+        file. The fluor and optional images are aligned when the mask is
+        computed. Can be called without a filename or by passing one as an
+        arg (filename=...)"""
+        if filename is None:
+            filename = tkFileDialog.askopenfilename(initialdir=self.working_dir)
+
+        self.working_dir = "/".join(filename.split("/")[:len(filename.split("/")) - 1])
+
+        self.base_path = filename
+        self.fluor_path = filename
+
+        self.image_manager.load_hyperstack(filename,
+                                           self.parameters.imageloaderparams)
+
+        print("Hyperstack Loaded")
+
+    def iter_timeseries(self, filename, prefetch=1):
+        """Generator that analyses each time frame of a hyperstack file,
+        from the mask to the processing of the cells, and yields the index of
+        the frame once its analysis is finished. The managers of this
+        instance hold the results of the frame until the next one is
+        requested.
+        The loaded networks and the ImageManager are kept for all the frames
+        and, with auto align, the alignment found on the first frame is used
+        on the others. The next prefetch frames are read from the disk on a
+        separate thread while the current one is analysed"""
+
+        self.base_path = filename
+        self.fluor_path = filename
+
+        params = self.parameters.imageloaderparams
+        frame_params = params
+
+        frames = prefetch_frames(read_frames(filename), prefetch)
+
+        for frame, channels in enumerate(frames):
+            self.merged_pairs = []
+
+            self.image_manager.set_channels(channels, filename, params)
+            self.image_manager.compute_mask(params)
+            self.image_manager.align_channels(frame_params)
+
+            if frame == 0 and params.auto_align:
+                frame_params = copy.copy(params)
+                frame_params.auto_align = False
+                frame_params.x_align, frame_params.y_align = \
+                    self.image_manager.align_values
+
+            self.compute_segments()
+            self.compute_cells()
+            self.process_cells()
+
+            yield frame
+
+    def analyse_timeseries(self, filename=None, output=None, label=None,
+                           prefetch=1):
+        """Analyses every time frame of a hyperstack file and writes the
+        reports of each frame to the output folder as soon as the frame is
+        finished, labeled with the frame index (e.g. label_t0003).
+        Can be called without a filename and output or by passing them as
+        args"""
+        if filename is None:
+            filename = tkFileDialog.askopenfilename(initialdir=self.working_dir)
+        if output is None:
+            output = tkFileDialog.askdirectory(initialdir=self.working_dir)
+        if label is None:
+            label = os.path.splitext(os.path.basename(filename))[0]
+
+        self.working_dir = "/".join(filename.split("/")[:len(filename.split("/")) - 1])
+
+        for frame in self.iter_timeseries(filename, prefetch):
+            self.generate_reports(output, label=label + "_t" + str(frame).zfill(4))
+
+            print("Frame " + str(frame) + " Finished")
+
     def compute_mask(self):
         """Calls the compute_mask method from image_manager."""
 
         self.image_manager.compute_mask(self.parameters.imageloaderparams)
 
-        if self.image_manager.fluor_image is not None:
+        if self.image_manager.channels is not None:
+            self.image_manager.align_channels(self.parameters.imageloaderparams)
+        elif self.image_manager.fluor_image is not None:
             self.load_fluor_image(self.fluor_path)
 
         print("Mask Computation Finished")
@@ -126,15 +209,13 @@ class EHooke(object):
             filename = tkFileDialog.askopenfilename(initialdir=self.working_dir)
 
         cells_list = open(filename, "r").readlines()
+        pairs = [tuple(pair.split(";")[:2]) for pair in cells_list]
 
-        for pair in cells_list:
-            tmp = pair.split(";")
-            self.cell_manager.merge_cells(tmp[0], tmp[1],
-                                          self.parameters,
-                                          self.segments_manager,
-                                          self.image_manager)
-
-            self.merged_pairs.append((tmp[0], tmp[1]))
+        self.cell_manager.merge_pairs(pairs,
+                                      self.parameters,
+                                      self.segments_manager,
+                                      self.image_manager)
+        self.merged_pairs.extend(pairs)
 
         self.cell_manager.overlay_cells(self.image_manager)
 
@@ -253,9 +334,24 @@ class EHooke(object):
 
     def compute_cellcyclephases(self):
 
-        self.cellcycleclassifier = CellCycleClassifier()
+        if self.cellcycleclassifier is None:
+            self.cellcycleclassifier = CellCycleClassifier()
         self.cellcycleclassifier.classify_cells(self.image_manager, self.cell_manager,
-                                                self.parameters.cellprocessingparams.microscope, self.parameters.cellprocessingparams.secondary_channel)
+                                                self.parameters.cellprocessingparams.microscope, self.parameters.cellprocessingparams.secondary_channel,
+                                                self.parameters.cellprocessingparams.classify_batch_size)
+
+    def warm_up_models(self):
+        """Loads the networks needed by the current parameters before the
+        analysis starts. Loaded networks are shared by every EHooke instance
+        of the process"""
+        cache_size = self.parameters.imageloaderparams.stardist_cache_size
+        if self.parameters.imageloaderparams.mask_algorithm == "StarDist":
+            warm_up_stardist(["StarDistSeg"], cache_size=cache_size)
+        elif self.parameters.imageloaderparams.mask_algorithm == "StarDist_BF":
+            warm_up_stardist(["StarDistSeg_BF"], cache_size=cache_size)
+
+        if self.parameters.cellprocessingparams.classify_cells:
+            warm_up_cellcycle_model()
 
     def select_cells_optional(self, signal_ratio):
         if self.image_manager.optional_image is not None:
@@ -8,22 +8,431 @@ the handling of the images and the computation of the mask.
 This class should also be responsible for the connection of this module
 with the main module of the software."""
 
+import os
+import time
+import queue
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
 from tkinter.filedialog import asksaveasfilename
 import numpy as np
-from copy import deepcopy
 from skimage.segmentation import mark_boundaries
 from skimage.io import imsave, imread
-from skimage.util import img_as_float, img_as_uint
+from skimage.util import img_as_float, img_as_float32, img_as_uint
 from skimage.filters import threshold_isodata, threshold_local
 from skimage import exposure, color, morphology
 from scipy import ndimage
 
 # AB
-from scipy.signal import fftconvolve
-from scipy.ndimage import center_of_mass
-from skimage.transform import EuclideanTransform, warp
 from csbdeep.utils import Path, normalize
 from stardist.models import StarDist2D, Config2D
+import alignment
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+# StarDist models already loaded in this process, by (name, basedir), from
+# the least to the most recently used
+stardist_models = OrderedDict()
+
+# pools of worker processes predicting StarDist tiles, by (name, basedir,
+# workers). The pool is kept between mask computations, so that each worker
+# only loads the model once
+stardist_tile_pools = {}
+
+
+def get_stardist_model(name, basedir=".", cache_size=0):
+    """Returns the StarDist2D model saved in basedir/name.
+    The model is only loaded the first time it is requested and then reused
+    by every mask computation of this process. When more than cache_size
+    models are loaded the least recently used is released, 0 keeps all of
+    them."""
+
+    key = (name, os.path.abspath(basedir))
+
+    if key in stardist_models:
+        model = stardist_models.pop(key)
+        stardist_models[key] = model
+        return model
+
+    start = time.time()
+    model = StarDist2D(None, name=name, basedir=basedir)
+    print("StarDist model " + name + " loaded in " +
+          "{0:.2f}".format(time.time() - start) + " s")
+
+    stardist_models[key] = model
+
+    if cache_size > 0:
+        while len(stardist_models) > cache_size:
+            stardist_models.popitem(last=False)
+
+    return model
+
+
+def warm_up_stardist(names=("StarDistSeg", "StarDistSeg_BF"), basedir=".",
+                     cache_size=0):
+    """Loads the StarDist models and runs a first prediction on a small blank
+    image, so that the first mask computation only pays for the inference"""
+
+    for name in names:
+        model = get_stardist_model(name, basedir, cache_size)
+        model.predict_instances(np.zeros((64, 64)))
+
+
+def release_stardist_models():
+    """Releases all the StarDist models loaded in this process and closes the
+    tile worker processes"""
+    stardist_models.clear()
+    close_stardist_tile_pools()
+
+
+def get_stardist_tile_pool(name, basedir, workers):
+    """Returns the pool of worker processes predicting the tiles of the
+    StarDist model saved in basedir/name, started the first time it is
+    requested. Each worker loads the model when it starts. A pool started
+    for another model or number of workers is closed"""
+
+    key = (name, os.path.abspath(basedir), workers)
+
+    if key not in stardist_tile_pools:
+        close_stardist_tile_pools()
+        # spawned, the worker processes cannot inherit the session of a
+        # model loaded in this process
+        stardist_tile_pools[key] = mp.get_context("spawn").Pool(
+            workers, initializer=get_stardist_model, initargs=(name, basedir))
+
+    return stardist_tile_pools[key]
+
+
+def close_stardist_tile_pools():
+    """Closes the pools of StarDist tile worker processes"""
+    for pool in stardist_tile_pools.values():
+        pool.close()
+        pool.join()
+    stardist_tile_pools.clear()
+
+
+def tile_starts(size, tile, step):
+    """Returns the starts of the tiles of length tile, step pixels apart,
+    that cover size pixels. The last tile ends at the border"""
+
+    starts = list(range(0, max(size - tile, 0) + 1, step))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+
+    return starts
+
+
+def tile_cores(starts, size, tile):
+    """Returns the (start, end) of the core of each tile, splitting the
+    overlap of consecutive tiles at its middle. The cores cover the size
+    pixels without overlapping"""
+
+    bounds = [0]
+    for ix in range(len(starts) - 1):
+        bounds.append((starts[ix + 1] + min(starts[ix] + tile, size)) // 2)
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def predict_stardist_tile(task):
+    """Predicts the instances of a single tile, inside a worker process of
+    predict_stardist"""
+    name, basedir, tile = task
+    return get_stardist_model(name, basedir).predict_instances(tile)
+
+
+def stardist_tiles(shape, params):
+    """Returns the (x0, y0, (xc0, xc1), (yc0, yc1)) start and core of each
+    tile predict_stardist splits an image of the shape into, or an empty
+    list when the image is predicted at once"""
+
+    tile = int(params.stardist_tile_size)
+    h, w = shape[:2]
+
+    if tile <= 0 or (h <= tile and w <= tile):
+        return []
+
+    step = max(tile - int(params.stardist_tile_overlap), 1)
+    xstarts = tile_starts(h, tile, step)
+    ystarts = tile_starts(w, tile, step)
+    xcores = tile_cores(xstarts, h, tile)
+    ycores = tile_cores(ystarts, w, tile)
+
+    return [(x0, y0, xc, yc) for x0, xc in zip(xstarts, xcores)
+            for y0, yc in zip(ystarts, ycores)]
+
+
+def load_stardist(name, shape, params, basedir="."):
+    """Loads the StarDist model where predict_stardist will use it for an
+    image of the shape: in this process, or in the tile worker processes
+    when the tiles are predicted by them"""
+
+    workers = int(params.stardist_tile_workers)
+    if workers > 1 and len(stardist_tiles(shape, params)) > 1:
+        get_stardist_tile_pool(name, basedir, workers)
+    else:
+        get_stardist_model(name, basedir, params.stardist_cache_size)
+
+
+def predict_stardist(name, image, params, basedir="."):
+    """Returns the labels and polygons predicted by the StarDist model for
+    the normalized image, as model.predict_instances.
+    When params.stardist_tile_size is larger than 0 and the image does not
+    fit in a single tile, the image is predicted in overlapping square tiles
+    so that the memory used by the network does not depend on the size of
+    the field. Each cell is kept from the tile whose core holds its center
+    and the overlap should be larger than the cells. With
+    params.stardist_tile_workers > 1 the tiles are predicted by a pool of
+    worker processes, each with its own copy of the model, which is kept
+    for the next images"""
+
+    tile = int(params.stardist_tile_size)
+    h, w = image.shape[:2]
+    tiles = stardist_tiles(image.shape, params)
+
+    if len(tiles) == 0:
+        return get_stardist_model(name, basedir).predict_instances(image)
+
+    tasks = ((name, basedir, image[x0:x0 + tile, y0:y0 + tile])
+             for x0, y0, xc, yc in tiles)
+
+    labels = np.zeros((h, w), dtype=np.int32)
+    polygons = {}
+
+    workers = int(params.stardist_tile_workers)
+    if workers > 1 and len(tiles) > 1:
+        pool = get_stardist_tile_pool(name, basedir, workers)
+        for tile_pos, result in zip(tiles, pool.imap(predict_stardist_tile, tasks)):
+            stitch_stardist_tile(labels, polygons, tile_pos, result)
+    else:
+        for tile_pos, task in zip(tiles, tasks):
+            stitch_stardist_tile(labels, polygons, tile_pos,
+                                 predict_stardist_tile(task))
+
+    if "points" not in polygons:
+        polygons["points"] = [np.zeros((0, 2), dtype=int)]
+
+    for key in polygons.keys():
+        polygons[key] = np.concatenate(polygons[key])
+
+    return labels, polygons
+
+
+def stitch_stardist_tile(labels, polygons, tile_pos, result):
+    """Copies the cells of a tile whose center is inside the core of the tile
+    to the labels of the whole image, renumbered after the ones already
+    there, and appends their polygons, moved to the image coordinates"""
+
+    x0, y0, (cx0, cx1), (cy0, cy1) = tile_pos
+    tile_labels, tile_polygons = result
+
+    points = np.asarray(tile_polygons["points"])
+    n = len(points)
+    keep = np.flatnonzero((points[:, 0] + x0 >= cx0) & (points[:, 0] + x0 < cx1) &
+                          (points[:, 1] + y0 >= cy0) & (points[:, 1] + y0 < cy1)) \
+        if n > 0 else np.zeros(0, dtype=int)
+
+    first = sum(len(v) for v in polygons.get("points", []))
+    offset = np.array([x0, y0])
+
+    th, tw = tile_labels.shape
+    region = labels[x0:x0 + th, y0:y0 + tw]
+    new_ids = np.zeros(n + 1, dtype=np.int32)
+    new_ids[keep + 1] = np.arange(first + 1, first + len(keep) + 1)
+    moved = new_ids[tile_labels]
+    # pixels claimed by the tiles before are kept
+    free = (region == 0) & (moved > 0)
+    region[free] = moved[free]
+
+    for key in tile_polygons.keys():
+        value = np.asarray(tile_polygons[key])
+        if value.ndim == 0 or len(value) != n:
+            continue
+        value = value[keep]
+        if key == "points":
+            value = value + offset
+        elif key == "coord":
+            value = value + offset[None, :, None]
+        polygons.setdefault(key, []).append(value)
+
+
+def read_image(filename):
+    """Reads an image file keeping the dtype of the file.
+    When tifffile is available, TIFF files stored uncompressed are
+    memory-mapped read only, so their pages are only read from the disk when
+    used. Other files are read with the imread function of skimage.io"""
+
+    if tifffile is not None and \
+            os.path.splitext(filename)[1].lower() in (".tif", ".tiff"):
+        try:
+            return tifffile.memmap(filename, mode="r")
+        except ValueError:
+            # compressed or tiled data cannot be memory-mapped
+            pass
+
+    return imread(filename)
+
+
+def read_stack(filename):
+    """Opens a multi-page or hyperstack TIFF file once and returns its array
+    and the axes of the array (e.g. "TCYX").
+    The pages are memory-mapped read only when the data is stored
+    uncompressed, so they are only read from the disk when used, and read in
+    a single pass otherwise.
+    The axes are taken from the ImageJ/OME metadata when available, files
+    without metadata have one image per page (Q)"""
+
+    if tifffile is None:
+        stack = imread(filename)
+        return stack, "Q" * (stack.ndim - 2) + "YX"
+
+    with tifffile.TiffFile(filename) as tif:
+        series = tif.series[0]
+
+        # older tifffile releases do not give the offset of the series
+        offset = getattr(series, "dataoffset", None)
+        if offset is not None:
+            stack = np.memmap(filename, mode="r", offset=offset,
+                              shape=series.shape,
+                              dtype=np.dtype(tif.byteorder + series.dtype.char))
+        else:
+            try:
+                stack = tifffile.memmap(filename, mode="r").reshape(series.shape)
+            except ValueError:
+                # compressed or tiled data cannot be memory-mapped
+                stack = series.asarray()
+
+        return stack, series.axes
+
+
+def split_channels(stack, axes, filename):
+    """Returns a list with the 2D image of each channel of the stack, as
+    views of the stack, not copies.
+    ImageJ/OME channels are C, RGB files use the samples axis S, files
+    without metadata have one channel per page. All the other axes (e.g. time
+    or z) must have a single plane"""
+
+    channel_axis = None
+    for name in "CSIQ":
+        if name in axes:
+            channel_axis = axes.index(name)
+            break
+
+    rows, cols = axes.index("Y"), axes.index("X")
+
+    index = []
+    for axis, size in enumerate(stack.shape):
+        if axis in (channel_axis, rows, cols):
+            index.append(slice(None))
+        elif size == 1:
+            index.append(0)
+        else:
+            raise ValueError("Axis " + axes[axis] + " of " + filename +
+                             " has " + str(size) + " planes, only one is supported")
+
+    stack = stack[tuple(index)]
+
+    if channel_axis is None:
+        return [stack]
+
+    # moveaxis and the iteration over the first axis only create views
+    channel_axis = sorted((channel_axis, rows, cols)).index(channel_axis)
+
+    return list(np.moveaxis(stack, channel_axis, 0))
+
+
+def read_channels(filename):
+    """Reads a multi-page or hyperstack TIFF file with one image per channel
+    and returns a list with the 2D image of each channel"""
+
+    stack, axes = read_stack(filename)
+
+    return split_channels(stack, axes, filename)
+
+
+def read_frames(filename):
+    """Generator over the time frames (T axis) of a hyperstack TIFF file,
+    yielding the list of channels of each frame as views of the file.
+    A file without a T axis is a single frame"""
+
+    stack, axes = read_stack(filename)
+
+    if "T" not in axes:
+        yield split_channels(stack, axes, filename)
+        return
+
+    frame_axis = axes.index("T")
+    frame_axes = axes.replace("T", "")
+
+    for frame in range(stack.shape[frame_axis]):
+        index = (slice(None),) * frame_axis + (frame,)
+        yield split_channels(stack[index], frame_axes, filename)
+
+
+def prefetch_frames(frames, size=1):
+    """Generator that reads up to size frames ahead of the one being used,
+    on a separate thread, so that reading frame t+1 from the disk overlaps
+    the processing of frame t.
+    frames is an iterator over lists of channels, such as read_frames.
+    The channels are copied to memory by the thread"""
+
+    if size < 1:
+        for channels in frames:
+            yield channels
+        return
+
+    loaded = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        # gives up when the frames are no longer being used
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for channels in frames:
+                if not put([np.array(channel) for channel in channels]):
+                    return
+            put(done)
+        except Exception as error:
+            put(error)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            channels = loaded.get()
+            if channels is done:
+                break
+            if isinstance(channels, Exception):
+                raise channels
+            yield channels
+    finally:
+        stop.set()
+        reader.join()
+
+
+def as_float(image, precision):
+    """Converts the image to float64, or to float32 with the Single
+    precision"""
+
+    if precision == "Single":
+        return img_as_float32(image)
+
+    return img_as_float(image)
 
 
 class ImageManager(object):
@@ -44,9 +453,48 @@ class ImageManager(object):
         self.fluor_w_mask = None
         self.optional_w_mask = None
         self.align_values = (0, 0)
+        self.mask_spectrum = None
+        self.channels = None
 
         self.stardist_labels = None
         self.stardist_polygons = None
+        self.stardist_load_time = 0
+        self.stardist_predict_time = 0
+
+    # the overlays of the mask are only created when first used and are
+    # cleared whenever the mask or the images change
+    @property
+    def base_w_mask(self):
+        if self._base_w_mask is None and self.base_image is not None and \
+                self.mask is not None:
+            self.overlay_mask_base_image()
+        return self._base_w_mask
+
+    @base_w_mask.setter
+    def base_w_mask(self, value):
+        self._base_w_mask = value
+
+    @property
+    def fluor_w_mask(self):
+        if self._fluor_w_mask is None and self.fluor_image is not None and \
+                self.mask is not None:
+            self.overlay_mask_fluor_image()
+        return self._fluor_w_mask
+
+    @fluor_w_mask.setter
+    def fluor_w_mask(self, value):
+        self._fluor_w_mask = value
+
+    @property
+    def optional_w_mask(self):
+        if self._optional_w_mask is None and self.optional_image is not None \
+                and self.mask is not None:
+            self.overlay_mask_optional_image()
+        return self._optional_w_mask
+
+    @optional_w_mask.setter
+    def optional_w_mask(self, value):
+        self._optional_w_mask = value
 
     def clear_all(self):
         """Sets the class back to the __init__ state"""
@@ -61,9 +509,13 @@ class ImageManager(object):
         self.fluor_w_mask = None
         self.optional_w_mask = None
         self.align_values = (0, 0)
+        self.mask_spectrum = None
+        self.channels = None
 
         self.stardist_labels = None
         self.stardist_polygons = None
+        self.stardist_load_time = 0
+        self.stardist_predict_time = 0
 
     def load_base_image(self, filename, params):
         """This method is responsible for the loading of the base image and
@@ -72,12 +524,19 @@ class ImageManager(object):
         compatible with the imread function of the scikit-image.io module)
         and an instance of the ImageLoadingParams of the parameters module."""
 
-        image = img_as_float(imread(filename))
+        self.channels = None
+        self.set_base_image(read_image(filename), params)
+
+    def set_base_image(self, image, params):
+        """Stores the image on self.base_image, after converting it to gray
+        and rescaling its intensity"""
+
+        image = as_float(image, params.precision)
 
         # note: changed order, rescale_intensity was called
         # before the rgb2gray, test to see which one is better
         image = color.rgb2gray(image)
-        image = exposure.rescale_intensity(image)
+        image = as_float(exposure.rescale_intensity(image), params.precision)
 
         self.base_image = image
 
@@ -130,9 +589,16 @@ class ImageManager(object):
             if params.invert_base:
                 base_mask = 1 - base_mask
 
-            model = StarDist2D(None, name="StarDistSeg", basedir='.')
+            start = time.time()
+            load_stardist("StarDistSeg", base_mask.shape, params, basedir='.')
+            self.stardist_load_time = time.time() - start
+
             base_mask = normalize(base_mask, 1, 99.8, axis=(0, 1))
-            self.stardist_labels, self.stardist_polygons = model.predict_instances(base_mask)
+
+            start = time.time()
+            self.stardist_labels, self.stardist_polygons = predict_stardist("StarDistSeg", base_mask, params, basedir='.')
+            self.stardist_predict_time = time.time() - start
+            self.print_stardist_times()
 
             base_mask = np.copy(self.stardist_labels)
 
@@ -144,9 +610,16 @@ class ImageManager(object):
             if params.invert_base:
                 base_mask = 1 - base_mask
 
-            model = StarDist2D(None, name="StarDistSeg_BF", basedir='.')
+            start = time.time()
+            load_stardist("StarDistSeg_BF", base_mask.shape, params, basedir='.')
+            self.stardist_load_time = time.time() - start
+
             base_mask = normalize(base_mask, 1, 99.8, axis=(0, 1))
-            self.stardist_labels, self.stardist_polygons = model.predict_instances(base_mask)
+
+            start = time.time()
+            self.stardist_labels, self.stardist_polygons = predict_stardist("StarDistSeg_BF", base_mask, params, basedir='.')
+            self.stardist_predict_time = time.time() - start
+            self.print_stardist_times()
 
             base_mask = np.copy(self.stardist_labels)
 
@@ -155,6 +628,13 @@ class ImageManager(object):
         else:
             print("Not a valid mask algorithm")
 
+    def print_stardist_times(self):
+        """Prints the time spent getting the StarDist model, which is only
+        significant when the model was not loaded yet, and the time spent on
+        the inference itself"""
+        print("StarDist model: " + "{0:.2f}".format(self.stardist_load_time) +
+              " s, inference: " + "{0:.2f}".format(self.stardist_predict_time) + " s")
+
     def compute_mask(self, params):
         """Creates the mask for the base image.
         Needs the base image and an instance of imageloaderparams
@@ -182,7 +662,15 @@ class ImageManager(object):
             mask = 1 - img_as_float(ndimage.binary_fill_holes(1.0 - mask))
 
         self.mask = mask
-        self.overlay_mask_base_image()
+        self.mask_spectrum = None
+
+        if params.precision == "Single":
+            self.base_mask = self.base_mask > 0.5
+            self.mask = self.mask > 0.5
+
+        self.base_w_mask = None
+        self.fluor_w_mask = None
+        self.optional_w_mask = None
 
     def load_fluor_image(self, filename, params):
         """This method is responsible for the loading of the fluor image and
@@ -191,64 +679,131 @@ class ImageManager(object):
         compatible with the imread function of the scikit-image.io module)
         and an instance of the ImageLoadingParams of the parameters module."""
 
-        inverted_mask = 1 - self.mask
+        self.set_fluor_image(read_image(filename), params)
 
-        fluor_image = imread(filename)
+    def set_fluor_image(self, fluor_image, params):
+        """Aligns the fluor image with the mask and stores it on
+        self.fluor_image. The raw image is kept on self.original_fluor_image"""
 
         if len(fluor_image.shape) > 2:
             fluor_image = color.rgb2gray(fluor_image)
 
-        self.original_fluor_image = deepcopy(fluor_image)
+        # not copied, the raw image is never changed in place
+        self.original_fluor_image = fluor_image
 
-        fluor_image = img_as_float(fluor_image)
+        fluor_image = as_float(fluor_image, params.precision)
 
         if params.auto_align:
-            # Alignment is done by taking the maximum of the correlation
-            # between phase and fluorescence (inverted mask so cells are white)
-            corr = fftconvolve(inverted_mask, fluor_image[::-1, ::-1])
-            deviation = np.unravel_index(np.argmax(corr), corr.shape)
-            cm = center_of_mass(np.ones(corr.shape))
-            best = np.subtract(deviation, cm)
+            best = self.find_alignment(fluor_image, params)
         else:
             best = (params.x_align, params.y_align)
 
         self.align_values = best
         dy, dx = best
-        final_matrix = EuclideanTransform(rotation=0, translation=(dx, dy))
-        self.original_fluor_image = warp(self.original_fluor_image, final_matrix.inverse, preserve_range=True)
-        self.fluor_image = warp(fluor_image, final_matrix.inverse, preserve_range=True)
 
-        self.overlay_mask_fluor_image()
+        # without a shift the raw image is kept, with the dtype of the file
+        if dx != 0 or dy != 0:
+            self.original_fluor_image = alignment.shift_image(self.original_fluor_image, best)
+            self.fluor_image = alignment.shift_image(fluor_image, best)
+        else:
+            self.fluor_image = fluor_image
+
+        self.fluor_w_mask = None
 
     def load_option_image(self, filename, params):
         """Loads an option image that can be used to look for the septum
         and to help classify the cell cycle phases. No fluorescence is measured
         on this image"""
 
-        inverted_mask = 1 - self.mask
+        self.set_option_image(read_image(filename), params)
 
-        optional_image = imread(filename)
+    def set_option_image(self, optional_image, params):
+        """Aligns the optional image with the mask and stores it on
+        self.optional_image"""
 
         if len(optional_image.shape) > 2:
             optional_image = color.rgb2gray(optional_image)
 
-        optional_image = img_as_float(optional_image)
+        optional_image = as_float(optional_image, params.precision)
 
         best = (0, 0)
 
         if params.auto_align:
-            # Alignment is done by taking the maximum of the correlation
-            # between phase and fluorescence
-            corr = fftconvolve(inverted_mask, optional_image[::-1, ::-1])
-            deviation = np.unravel_index(np.argmax(corr), corr.shape)
-            cm = center_of_mass(np.ones(corr.shape))
-            best = np.subtract(deviation, cm)
+            best = self.find_alignment(optional_image, params)
         else:
             best = (params.x_align, params.y_align)
 
-        dx, dy = best
-        matrix = EuclideanTransform(rotation=0, translation=(dx, dy))
-        self.optional_image = warp(optional_image, matrix.inverse, preserve_range=True)
+        dy, dx = best
+        if dx != 0 or dy != 0:
+            self.optional_image = alignment.shift_image(optional_image, best)
+        else:
+            self.optional_image = optional_image
+
+        self.optional_w_mask = None
+
+    def load_hyperstack(self, filename, params):
+        """Loads a multi-page or hyperstack TIFF file with the base, fluor
+        and optional images as channels, in a single read of the file.
+        The channel of each image is set by the base channel, fluor channel
+        and optional channel parameters (the optional image is skipped when
+        its channel is -1 or not in the file).
+        Only the base image is stored, the other channels are kept on
+        self.channels until the mask is computed and they can be aligned with
+        align_channels"""
+
+        self.set_channels(read_channels(filename), filename, params)
+
+    def set_channels(self, channels, filename, params):
+        """Assigns the channels of a hyperstack, or of a frame of a time
+        series, to the base, fluor and optional images and stores the base
+        image. There is no optional image when the optional channel is
+        negative or not in the hyperstack"""
+
+        roles = {"base": params.base_channel,
+                 "fluor": params.fluor_channel,
+                 "optional": params.optional_channel}
+
+        self.channels = {}
+        for role, channel in roles.items():
+            if 0 <= channel < len(channels):
+                self.channels[role] = channels[channel]
+            elif role == "optional":
+                # as with single files, the optional image may be missing
+                self.channels[role] = None
+            else:
+                raise ValueError(filename + " has " + str(len(channels)) +
+                                 " channels, " + role + " channel " +
+                                 str(channel) + " not found")
+
+        self.set_base_image(self.channels["base"], params)
+
+    def align_channels(self, params):
+        """Aligns the fluor and optional channels of the hyperstack with the
+        mask, as load_fluor_image and load_option_image do with single files"""
+
+        self.set_fluor_image(self.channels["fluor"], params)
+
+        if self.channels["optional"] is not None:
+            self.set_option_image(self.channels["optional"], params)
+
+    def find_alignment(self, image, params):
+        """Returns the (row, column) shift that aligns the image with the
+        mask, taken from the maximum of the correlation between the image and
+        the inverted mask (so cells are white).
+        With the Phase Correlation algorithm the spectrum of the mask is
+        computed once and reused for every image until the mask changes"""
+
+        if params.align_algorithm == "Phase Correlation" and \
+                image.shape == self.mask.shape:
+            if self.mask_spectrum is None:
+                self.mask_spectrum = alignment.mask_spectrum(1 - self.mask)
+
+            return alignment.phase_correlation_shift(self.mask_spectrum, image,
+                                                     params.align_max_shift,
+                                                     params.align_subpixel)
+
+        return alignment.correlation_shift(1 - self.mask, image,
+                                           params.align_max_shift)
 
     def overlay_mask_base_image(self):
         """ Creates a new image with an overlay of the mask
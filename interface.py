@@ -213,11 +213,17 @@ class Interface(object):
 
     def load_parameters(self):
         """Loads a .cfg with the parameters and sets them as the default
-        params"""
+        params. The networks the loaded parameters use are loaded right away,
+        so that the first mask or classification does not wait for them"""
         self.ehooke.parameters.load_parameters()
         self.default_params = self.ehooke.parameters
         self.load_default_params_imgloader()
 
+        try:
+            self.ehooke.warm_up_models()
+        except Exception:
+            print("Could not load the networks before the analysis")
+
     def save_parameters(self):
         """Saves the current parameters in a .cfg file"""
         self.ehooke.parameters.save_parameters()
@@ -68,6 +68,16 @@ class MaskParameters(object):
         self.mask_algorithms = ['Local Average', 'Isodata', 'StarDist']
         self.mask_algorithm = 'Isodata'
 
+        # used for the StarDist algorithms, images larger than the tile
+        # size are predicted in overlapping tiles, 0 predicts the whole image
+        # at once. the overlap should be larger than the cells
+        self.stardist_tile_size = 0
+        self.stardist_tile_overlap = 128
+        self.stardist_tile_workers = 1
+
+        # maximum number of StarDist models kept loaded, 0 keeps all of them
+        self.stardist_cache_size = 0
+
         # used for local average algorithm
         self.mask_blocksize = 151  # block size for moving average
         self.mask_offset = 0.02    # offset for moving average
@@ -81,13 +91,30 @@ class MaskParameters(object):
         self.mask_dilation = 0  # mask dilation iterations
 
         self.auto_align = True
+        self.align_algorithms = ["Correlation", "Phase Correlation"]
+        self.align_algorithm = "Correlation"
+        # largest shift searched by the auto alignment, 0 searches all
+        self.align_max_shift = 0
+        self.align_subpixel = False
 
         self.x_align = 0
         self.y_align = 0
 
+        # channels of the images on hyperstack files, the optional image is
+        # skipped when its channel is -1 or not in the file
+        self.base_channel = 0
+        self.fluor_channel = 1
+        self.optional_channel = 2
+
         self.pixel_size = "1"
         self.units = "px"
 
+        # Double keeps every image as float64 and the masks as float 0/1
+        # arrays. Single uses float32 images, keeps the raw intensities in
+        # the dtype of the file and stores the masks as bool
+        self.precisions = ["Double", "Single"]
+        self.precision = "Double"
+
     def load_from_parser(self, parser, section):
         """Loads frame parameters from a ConfigParser object of the
         configuration file. The section parameters specifies the configuration
@@ -98,14 +125,35 @@ class MaskParameters(object):
         self.mask_algorithm = str(parser.get(section, "mask algorithm"))
         self.mask_blocksize = int(parser.get(section, "mask blocksize"))
         self.mask_offset = float(parser.get(section, "mask offset"))
+        self.stardist_tile_size = int(parser.get(section, "stardist tile size",
+                                                 fallback="0"))
+        self.stardist_tile_overlap = int(parser.get(section, "stardist tile overlap",
+                                                    fallback="128"))
+        self.stardist_tile_workers = int(parser.get(section, "stardist tile workers",
+                                                    fallback="1"))
+        self.stardist_cache_size = int(parser.get(section, "stardist cache size",
+                                                  fallback="0"))
         self.mask_fill_holes = check_bool(parser.get(section, "mask fill holes"))
         self.mask_closing = int(float(parser.get(section, "mask closing")))
         self.mask_dilation = int(parser.get(section, "mask dilation"))
         self.auto_align = check_bool(parser.get(section, "auto align"))
+        self.align_algorithm = str(parser.get(section, "align algorithm",
+                                              fallback="Correlation"))
+        self.align_max_shift = int(parser.get(section, "align max shift",
+                                              fallback="0"))
+        self.align_subpixel = check_bool(parser.get(section, "align subpixel",
+                                                    fallback="False"))
         self.x_align = int(parser.get(section, "x align"))
         self.y_align = int(parser.get(section, "y align"))
+        self.base_channel = int(parser.get(section, "base channel",
+                                           fallback="0"))
+        self.fluor_channel = int(parser.get(section, "fluor channel",
+                                            fallback="1"))
+        self.optional_channel = int(parser.get(section, "optional channel",
+                                               fallback="2"))
         self.pixel_size = str(parser.get(section, "pixel size"))
         self.units = str(parser.get(section, "units"))
+        self.precision = str(parser.get(section, "precision", fallback="Double"))
 
     def save_to_parser(self, parser, section):
         """Saves mask parameters to a ConfigParser object of the
@@ -121,14 +169,25 @@ class MaskParameters(object):
         parser.set(section, "mask algorithm", str(self.mask_algorithm))
         parser.set(section, "mask blocksize", str(self.mask_blocksize))
         parser.set(section, "mask offset", str(self.mask_offset))
+        parser.set(section, "stardist tile size", str(self.stardist_tile_size))
+        parser.set(section, "stardist tile overlap", str(self.stardist_tile_overlap))
+        parser.set(section, "stardist tile workers", str(self.stardist_tile_workers))
+        parser.set(section, "stardist cache size", str(self.stardist_cache_size))
         parser.set(section, "mask fill holes", str(self.mask_fill_holes))
         parser.set(section, "mask closing", str(self.mask_closing))
         parser.set(section, "mask dilation", str(self.mask_dilation))
         parser.set(section, "auto align", str(self.auto_align))
+        parser.set(section, "align algorithm", str(self.align_algorithm))
+        parser.set(section, "align max shift", str(self.align_max_shift))
+        parser.set(section, "align subpixel", str(self.align_subpixel))
         parser.set(section, "x align", str(self.x_align))
         parser.set(section, "y align", str(self.y_align))
+        parser.set(section, "base channel", str(self.base_channel))
+        parser.set(section, "fluor channel", str(self.fluor_channel))
+        parser.set(section, "optional channel", str(self.optional_channel))
         parser.set(section, "pixel size", str(self.pixel_size))
         parser.set(section, "units", str(self.units))
+        parser.set(section, "precision", str(self.precision))
 
 
 class RegionParameters(object):
@@ -181,6 +240,8 @@ class CellParameters(object):
 
     def __init__(self):
         self.axial_step = 5
+        self.axes_algorithms = ["Rotations", "Batched", "Stepped Calipers", "Calipers"]
+        self.axes_algorithm = "Rotations"
 
         self.find_septum = False
         self.find_openseptum = False
@@ -192,6 +253,7 @@ class CellParameters(object):
         # microscope options for cyphid
 
         self.classify_cells = False
+        self.classify_batch_size = 256
         self.microscope = "Epifluorescence"
         self.microscope_options = ["Epifluorescence", "SIM"]
 
@@ -220,9 +282,23 @@ class CellParameters(object):
         # margin for local baseline
         self.baseline_margin = 30
 
+        # background of the baseline found around each cell or once for the
+        # whole image
+        self.baseline_algorithms = ["Per Cell", "Global"]
+        self.baseline_algorithm = "Per Cell"
+
+        # fluorescence stats computed for each cell or for all the cells at
+        # once, from the whole fluor image
+        self.fluor_stats_algorithms = ["Per Cell", "Whole Image"]
+        self.fluor_stats_algorithm = "Per Cell"
+
         # display
         self.cell_colors = 10
 
+        # number of processes used to compute the regions and stats of the
+        # cells, 1 processes the cells sequentially
+        self.processing_workers = 1
+
     def process_filters(self, text):
         filters = []
         if len(text.split(")")) > 1:
@@ -246,9 +322,13 @@ class CellParameters(object):
         file section"""
         # todo update load and save of pars
         self.axial_step = int(parser.get(section, "axial step"))
+        self.axes_algorithm = str(parser.get(section, "axes algorithm",
+                                             fallback="Rotations"))
         self.find_septum = check_bool(parser.get(section, "find septum"))
         self.find_openseptum = check_bool(parser.get(section, "find open septum"))
         self.classify_cells = check_bool(parser.get(section, "classify cells"))
+        self.classify_batch_size = max(1, int(parser.get(section, "classify batch size",
+                                                         fallback="256")))
         self.microscope = str(parser.get(section, "microscope"))
         self.look_for_septum_in_base = check_bool(parser.get(section,
                                                   "look for septum in base"))
@@ -263,8 +343,14 @@ class CellParameters(object):
         self.merge_min_interface = int(parser.get(section, "merge min interface"))
         self.inner_mask_thickness = int(parser.get(section, "inner mask thickness"))
         self.baseline_margin = int(parser.get(section, "baseline margin"))
+        self.baseline_algorithm = str(parser.get(section, "baseline algorithm",
+                                                 fallback="Per Cell"))
+        self.fluor_stats_algorithm = str(parser.get(section, "fluor stats algorithm",
+                                                    fallback="Per Cell"))
         self.cell_colors = int(parser.get(section, "cell colors"))
         self.signal_ratio = float(parser.get(section, "signal ratio"))
+        self.processing_workers = int(parser.get(section, "processing workers",
+                                                 fallback="1"))
 
     def save_to_parser(self, parser, section):
         """Saves mask parameters to a ConfigParser object of the configuration
@@ -274,9 +360,11 @@ class CellParameters(object):
             parser.add_section(section)
 
         parser.set(section, "axial step", str(self.axial_step))
+        parser.set(section, "axes algorithm", str(self.axes_algorithm))
         parser.set(section, "find septum", str(self.find_septum))
         parser.set(section, "find open septum", str(self.find_openseptum))
         parser.set(section, "classify cells", str(self.classify_cells))
+        parser.set(section, "classify batch size", str(self.classify_batch_size))
         parser.set(section, "microscope", str(self.microscope))
         parser.set(section, "look for septum in base",
                    str(self.look_for_septum_in_base))
@@ -291,5 +379,8 @@ class CellParameters(object):
         parser.set(section, "merge min interface", str(self.merge_min_interface))
         parser.set(section, "inner mask thickness", str(self.inner_mask_thickness))
         parser.set(section, "baseline margin", str(self.baseline_margin))
+        parser.set(section, "baseline algorithm", str(self.baseline_algorithm))
+        parser.set(section, "fluor stats algorithm", str(self.fluor_stats_algorithm))
         parser.set(section, "cell colors", str(self.cell_colors))
         parser.set(section, "signal ratio", str(self.signal_ratio))
+        parser.set(section, "processing workers", str(self.processing_workers))
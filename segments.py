@@ -10,12 +10,13 @@ import numpy as np
 from skimage.feature import peak_local_max
 from skimage import morphology
 from scipy import ndimage
+from scipy.spatial import cKDTree
 from skimage.io import imsave
 from skimage.util import img_as_int
 from tkinter.filedialog import asksaveasfilename
+import alignment
 
 # AB
-from skimage.transform import EuclideanTransform, warp
 
 
 class SegmentsManager(object):
@@ -59,28 +60,41 @@ class SegmentsManager(object):
                                  num_peaks=params.max_peaks,
                                  indices=True)
 
-        placedmask = np.ones(distance.shape)
+        return SegmentsManager.select_peaks(centers, distance, mindist, minmargin)
+
+    @staticmethod
+    def select_peaks(centers, distance, mindist, minmargin):
+        """Returns the centers found by peak_local_max that are at least
+        minmargin away from the edges and not within mindist of a center
+        placed before them, sorted by their height on the distance map"""
+
+        centers = np.reshape(centers, (-1, 2))
         lx, ly = distance.shape
-        result = []
-        heights = []
-        circles = []
 
-        for c in centers:
-            x, y = c
+        inside = (centers >= minmargin) & \
+                 (centers <= (lx - minmargin, ly - minmargin))
+        centers = centers[np.all(inside, axis=1)]
+
+        # a center is placed unless a center placed before it is within
+        # mindist on both axes. Centers closer than mindist to the top or left
+        # edge do not exclude others, as the squares once painted on a mask
+        pairs = cKDTree(centers).query_pairs(mindist, p=np.inf,
+                                             output_type="ndarray")
+        pairs = pairs[np.argsort(pairs[:, 0], kind="stable")]
+        starts = np.searchsorted(pairs[:, 0], np.arange(len(centers) + 1))
+        excludes = np.all(centers >= mindist, axis=1)
 
-            if x >= minmargin and y >= minmargin and x <= lx - minmargin \
-                    and y <= ly - minmargin and placedmask[x, y]:
-                placedmask[x - mindist:x + mindist +
-                                       1, y - mindist:y + mindist + 1] = 0
-                s = distance[x, y]
-                circles.append((x, y))
-                heights.append(s)
+        # only the few centers with close neighbours need the greedy loop,
+        # peak_local_max already keeps the others apart
+        placed = np.ones(len(centers), dtype=bool)
+        for ix in np.unique(pairs[:, 0]):
+            if placed[ix] and excludes[ix]:
+                placed[pairs[starts[ix]:starts[ix + 1], 1]] = False
 
-        ixs = np.argsort(heights)
-        for ix in ixs:
-            result.append(circles[ix])
+        circles = centers[placed]
+        heights = distance[circles[:, 0], circles[:, 1]]
 
-        return result
+        return [tuple(c) for c in circles[np.argsort(heights)]]
 
     def compute_features(self, params, image_manager):
         """Method used to compute the features of an image using the mask.
@@ -183,9 +197,7 @@ class SegmentsManager(object):
 
     def save_labels_aligned(self, filename, image_manager):
         best = image_manager.align_values
-        dy, dx = best
-        final_matrix = EuclideanTransform(rotation=0, translation=(-dx, -dy))
-        mask_aligned = warp(self.labels, final_matrix.inverse, preserve_range=True)
+        mask_aligned = alignment.shift_image(self.labels, np.negative(best), order=0)
 
         # ONLY DO THIS IN CASES WHERE THE VALUES HAVE NO PHYSICAL SIGNIFICANCE
         mask_aligned = np.array(mask_aligned, dtype=np.int32)